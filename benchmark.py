@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py -- microbenchmarks against the App Engine local stubs
+
+Each benchmark seeds the testbed with loadtest's seed data and times one
+code path, comparing it with the implementation it replaced.
+
+    python benchmark.py --sdk ~/google_appengine serialization
+    python benchmark.py --sdk ~/google_appengine queryConferences
+    python benchmark.py --sdk ~/google_appengine roundTrips
+
+serialization copies 10k Conferences and 10k Sessions to forms with the
+cached form mappers and with the reflective all_fields() loop they
+replaced, checks both produce the same messages, and reports the best of
+several runs for each.
+
+queryConferences runs the same filtered queries through the original
+implementation, which iterated the query once for the organizer lookup
+and again for the forms, and through the current one, cold and with its
+page cache warm, reporting RPCs per call by type and median latency.
+
+roundTrips calls every loadtest scenario and reports its serial round
+trips per call, counting RPCs that overlap another in-flight RPC as part
+of the same trip, next to its RPCs per call and median latency.
+
+"""
+
+import argparse
+import os
+import random
+import time
+
+from loadtest import CITIES
+
+import loadtest
+
+REPEAT = 5
+
+
+def best(repeat, func):
+    """Return the fastest of repeat timed calls of func, in ms."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+    return min(times)
+
+
+def measure(calls, func, cold=True):
+    """Run func calls times, counting RPCs; returns (median ms, RPCs per
+    call by category, round trips per call). cold calls start with empty
+    ndb and memcache caches."""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import instrumentation
+
+    times = []
+    totals = {}
+    round_trips = 0
+    for i in range(calls):
+        ndb.get_context().clear_cache()
+        if cold:
+            memcache.flush_all()
+        start = time.time()
+        with instrumentation.counting() as counts:
+            func(i)
+        times.append((time.time() - start) * 1000)
+        for category, count in counts.iteritems():
+            totals[category] = totals.get(category, 0) + count
+        round_trips += counts.roundTrips
+    return (loadtest.percentile(times, 0.5),
+            dict((category, float(count) / calls)
+                 for category, count in totals.iteritems()),
+            float(round_trips) / calls)
+
+
+def printMeasurements(rows):
+    """Print (label, measure() result) rows."""
+    print('%-34s %10s %10s %10s  %s' % ('', 'p50 ms', 'trips/call',
+                                        'RPCs/call', 'by type'))
+    for label, (median, rpcs, round_trips) in rows:
+        print('%-34s %10.2f %10.2f %10.2f  %s' % (
+            label, median, round_trips, sum(rpcs.values()),
+            ', '.join('%s %.2f' % item for item in sorted(rpcs.items()))))
+
+
+def reflectiveCopy(entity, form_cls, string_fields):
+    """Copy entity to form_cls the way _copy*ToForm did before mappers:
+    walking all_fields() with hasattr/getattr for every entity."""
+    form = form_cls()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            if field.name in string_fields:
+                setattr(form, field.name, str(getattr(entity, field.name)))
+            else:
+                setattr(form, field.name, getattr(entity, field.name))
+        elif field.name == 'websafeKey':
+            setattr(form, field.name, entity.key.urlsafe())
+    form.check_initialized()
+    return form
+
+
+def serialization(args):
+    """Time mapper and reflective copies of every seeded entity."""
+    from mappers import mapperFor
+    from models import Conference, ConferenceForm, Session, SessionForm
+
+    loadtest.seed(args.conferences, args.sessions, args.profiles,
+                  random.Random(args.seed))
+    cases = [
+        ('Conference', Conference.query().fetch(), ConferenceForm,
+         ('startDate', 'endDate')),
+        ('Session', Session.query().fetch(), SessionForm,
+         ('date', 'startTime')),
+    ]
+
+    rows = []
+    for name, entities, form_cls, string_fields in cases:
+        mapper = mapperFor(type(entities[0]), form_cls)
+        for entity in entities:
+            if mapper.copy(entity) != reflectiveCopy(entity, form_cls,
+                                                     string_fields):
+                raise AssertionError('%s %s copies differ'
+                                     % (name, entity.key))
+        rows.append((name, len(entities),
+                     best(args.repeat, lambda: [
+                         mapper.copy(entity) for entity in entities]),
+                     best(args.repeat, lambda: [
+                         reflectiveCopy(entity, form_cls, string_fields)
+                         for entity in entities])))
+
+    print('%-12s %8s %12s %14s %8s' % ('kind', 'entities', 'mapper ms',
+                                       'reflective ms', 'speedup'))
+    for name, count, mapper_ms, reflective_ms in rows:
+        print('%-12s %8d %12.1f %14.1f %7.1fx' % (
+            name, count, mapper_ms, reflective_ms, reflective_ms / mapper_ms))
+
+
+def legacyQueryConferences(api, request):
+    """queryConferences as originally written: the query runs once for
+    the organizer Profiles and again for the forms."""
+    from google.appengine.ext import ndb
+    from conference import DEFAULT_PAGE_SIZE
+    from models import ConferenceForm, ConferenceForms, Profile
+
+    conferences = api._getQuery(request)
+    page_size = request.pageSize or DEFAULT_PAGE_SIZE
+    organisers = [ndb.Key(Profile, conf.organizerUserId)
+                  for conf in conferences.iter(limit=page_size)]
+    names = dict((profile.key.id(), profile.displayName)
+                 for profile in ndb.get_multi(organisers) if profile)
+    items = []
+    for conf in conferences.iter(limit=page_size):
+        form = reflectiveCopy(conf, ConferenceForm, ('startDate', 'endDate'))
+        form.organizerDisplayName = names.get(conf.organizerUserId)
+        items.append(form)
+    return ConferenceForms(items=items)
+
+
+def queryConferences(args):
+    """Compare RPCs and latency of the original and current
+    queryConferences."""
+    from conference import ConferenceApi
+    from models import ConferenceQueryForm, ConferenceQueryForms
+
+    loadtest.seed(args.conferences, args.sessions, args.profiles,
+                  random.Random(args.seed))
+    requests = [ConferenceQueryForms(filters=[ConferenceQueryForm(
+        field='CITY', operator='EQ', value=city)]) for city in CITIES]
+
+    def call(func):
+        return lambda i: func(ConferenceApi(), requests[i % len(requests)])
+
+    printMeasurements([
+        ('before', measure(args.calls, call(legacyQueryConferences))),
+        ('after, cold cache', measure(args.calls, call(
+            lambda api, request: api.queryConferences(request)))),
+        ('after, warm page cache', measure(args.calls, call(
+            lambda api, request: api.queryConferences(request)),
+            cold=False)),
+    ])
+
+
+def roundTrips(args):
+    """Report serial round trips per call for every loadtest scenario."""
+    import endpoints
+    from google.appengine.api import users
+    from conference import ConferenceApi
+
+    data = loadtest.seed(args.conferences, args.sessions, args.profiles,
+                         random.Random(args.seed))
+    rng = random.Random(args.seed)
+    rows = []
+    for name, call in loadtest.scenarios():
+        def run(i):
+            api = ConferenceApi()
+            api._user = users.User(rng.choice(data['emails']))
+            try:
+                call(api, data, rng)
+            except endpoints.ServiceException:
+                pass
+        rows.append((name, measure(args.calls, run, cold=not args.warm)))
+    printMeasurements(rows)
+
+
+BENCHMARKS = {
+    'serialization': serialization,
+    'queryConferences': queryConferences,
+    'roundTrips': roundTrips,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--conferences', type=int, default=10000)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--profiles', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--calls', type=int, default=100,
+                        help='calls per measurement')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep memcache between roundTrips calls')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    bed = loadtest.setUpTestbed(args.sdk)
+    try:
+        BENCHMARKS[args.benchmark](args)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+bulk.py -- bulk import and export of conferences and sessions
+
+Imports read an uploaded JSONL or CSV blob one batch of lines per task,
+checkpointing the byte offset on an ImportJob so a failed task resumes
+where the last batch ended. Records get keys derived from their ids, so
+replaying a batch never creates duplicates; records whose keys already
+exist are skipped.
+
+Each record is one line. JSONL lines are objects; CSV files start with a
+header row and separate repeated values (topics) with ';'. Every record
+has a 'kind' of 'conference' or 'session' and an 'id' unique within its
+kind (numeric ids become integer key ids, as the API allocates them, so
+an export re-imports onto the same keys), and is otherwise validated as a ConferenceForm or SessionForm. A
+session names its conference by that conference's import 'conference'
+id or by 'websafeConferenceKey'. Conferences are created for the job's
+organizer and no confirmation emails are sent.
+
+Exports page through Conferences and then Sessions with query cursors,
+in the same JSONL record format.
+
+"""
+
+import csv
+import json
+
+import endpoints
+from protorpc import messages
+from protorpc import protojson
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from mappers import mapperFor
+from models import Conference
+from models import ConferenceForm
+from models import ImportJob
+from models import Profile
+from models import Session
+from models import SessionForm
+
+IMPORT_BATCH_SIZE = 200
+IMPORT_BUFFER_SIZE = 1024 * 1024
+MAX_IMPORT_ERRORS = 100
+EXPORT_PAGE_SIZE = 500
+EXPORT_KINDS = ('conference', 'session')
+
+
+def startImport(blob_key, fmt, organizer_user_id):
+    """Create an ImportJob for an uploaded blob and queue its first batch."""
+    job = ImportJob(blobKey=blob_key, format=fmt,
+                    organizerUserId=organizer_user_id, errors=[])
+    job.put()
+    _enqueueBatch(job)
+    return job
+
+
+def _enqueueBatch(job):
+    """Queue the batch starting at the job's offset, once."""
+    try:
+        taskqueue.add(params={'jobId': job.key.id()},
+                      url='/tasks/import',
+                      name='import-%d-%d' % (job.key.id(), job.offset)
+                      )
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def runImportBatch(job_id):
+    """Import the next batch of records for a job and checkpoint it.
+
+    Nothing is saved on the job until the batch is written, so a task
+    that fails part way is retried from the previous checkpoint.
+    """
+    job = ImportJob.get_by_id(int(job_id))
+    if job is None or job.done:
+        return
+
+    reader = blobstore.BlobReader(job.blobKey, position=job.offset,
+                                  buffer_size=IMPORT_BUFFER_SIZE)
+    records = []
+    while len(records) < IMPORT_BATCH_SIZE:
+        line = reader.readline()
+        if not line:
+            job.done = True
+            break
+        job.lineNumber += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = _parseLine(job, line)
+        except ValueError as e:
+            _recordError(job, job.lineNumber, e)
+            continue
+        if record is not None:
+            records.append((job.lineNumber, record))
+    offset = reader.tell()
+    reader.close()
+
+    _importRecords(job, records)
+    job.offset = offset
+    job.put()
+    if not job.done:
+        _enqueueBatch(job)
+
+
+def _parseLine(job, line):
+    """Return the record dict on a line, or None for a CSV header."""
+    if job.format == 'csv':
+        row = [value.decode('utf-8') for value in next(csv.reader([line]))]
+        if not job.header:
+            job.header = [name.strip() for name in row]
+            return None
+        if len(row) != len(job.header):
+            raise ValueError('Expected %d columns, got %d.'
+                             % (len(job.header), len(row)))
+        return dict((name, value) for name, value in zip(job.header, row)
+                    if value != '')
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('Each line must be a JSON object.')
+    return record
+
+
+def _recordError(job, line_number, error):
+    job.errorCount += 1
+    if len(job.errors) < MAX_IMPORT_ERRORS:
+        job.errors.append([line_number, unicode(error)])
+
+
+def _formFromRecord(form_cls, record):
+    """Return a form_cls message copied from a record; ValueError if it
+    does not validate."""
+    form = form_cls()
+    for field in form_cls.all_fields():
+        value = record.get(field.name)
+        if value in (None, '', []):
+            continue
+        if field.repeated and isinstance(value, basestring):
+            value = [item.strip() for item in value.split(';')
+                     if item.strip()]
+        try:
+            if isinstance(field, messages.IntegerField):
+                value = ([int(item) for item in value] if field.repeated
+                         else int(value))
+            setattr(form, field.name, value)
+        except (TypeError, ValueError, messages.ValidationError) as e:
+            # JSON values of the wrong type, e.g. a list for an integer
+            raise ValueError('%s: %s' % (field.name, e))
+    try:
+        form.check_initialized()
+    except messages.ValidationError as e:
+        raise ValueError(str(e))
+    return form
+
+
+def _keyId(record_id):
+    """Return the key id for a record id: an int if it is numeric."""
+    record_id = unicode(record_id)
+    if record_id.isdigit() and not record_id.startswith('0'):
+        return int(record_id)
+    return record_id
+
+
+def _conferenceKey(organizer_user_id, record_id):
+    return ndb.Key(Profile, organizer_user_id,
+                   Conference, _keyId(record_id))
+
+
+def _reserveIds(model, keys):
+    """Keep the id allocator from handing out the integer ids used."""
+    top = {}
+    for key in keys:
+        if isinstance(key.id(), (int, long)):
+            top[key.parent()] = max(top.get(key.parent(), 0), key.id())
+    for parent, max_id in top.iteritems():
+        model.allocate_ids(max=max_id, parent=parent)
+
+
+def _sessionConferenceKey(job, record):
+    """Return the key of the conference a session record belongs to."""
+    if record.get('conference'):
+        return _conferenceKey(job.organizerUserId, record['conference'])
+    try:
+        c_key = ndb.Key(urlsafe=record['websafeConferenceKey'])
+    except Exception:
+        raise ValueError('Session needs a conference or a valid '
+                         'websafeConferenceKey.')
+    if c_key.parent() != ndb.Key(Profile, job.organizerUserId):
+        raise ValueError('Conference %s is not organized by %s.'
+                         % (c_key.urlsafe(), job.organizerUserId))
+    return c_key
+
+
+def _importRecords(job, records):
+    """Validate a batch of records and write the new ones."""
+    api = ConferenceApi()
+    profile = ndb.Key(Profile, job.organizerUserId).get()
+    display_name = profile.displayName if profile else ''
+
+    conferences = {}
+    sessions = {}
+    for line_number, record in records:
+        try:
+            if not record.get('id'):
+                raise ValueError("Record 'id' required.")
+            kind = record.get('kind')
+            if kind == 'conference':
+                conf = api._conferenceFromForm(
+                    _formFromRecord(ConferenceForm, record),
+                    job.organizerUserId, display_name)
+                conf.key = _conferenceKey(job.organizerUserId, record['id'])
+                conferences[conf.key] = conf
+            elif kind == 'session':
+                sesh = api._sessionFromForm(
+                    _formFromRecord(SessionForm, record))
+                c_key = _sessionConferenceKey(job, record)
+                sesh.key = ndb.Key(Session, _keyId(record['id']),
+                                   parent=c_key)
+                sessions.setdefault(c_key, {})[sesh.key] = sesh
+            else:
+                raise ValueError("Record 'kind' must be 'conference' or "
+                                 "'session'.")
+        except (TypeError, ValueError, endpoints.ServiceException) as e:
+            # one bad record must not fail, and endlessly retry, the batch
+            _recordError(job, line_number, e)
+
+    # conferences first, so sessions in the same batch can refer to them
+    if conferences:
+        existing = ndb.get_multi(conferences.keys())
+        new = [conf for conf, found in zip(conferences.values(), existing)
+               if found is None]
+        _reserveIds(Conference, [conf.key for conf in new])
+        entities = []
+        for conf in new:
+            entities.append(conf)
+            entities.extend(api._newConferenceEntities(conf))
+        ndb.put_multi(entities)
+        api._bumpConferenceQueryCache()
+        job.created += len(new)
+        job.skipped += len(conferences) - len(new)
+
+    for c_key, by_key in sessions.iteritems():
+        if c_key.get() is None:
+            _recordError(job, job.lineNumber, 'No conference found with '
+                         'key: %s; %d sessions skipped.'
+                         % (c_key.urlsafe(), len(by_key)))
+            continue
+        existing = ndb.get_multi(by_key.keys())
+        new = [sesh for sesh, found in zip(by_key.values(), existing)
+               if found is None]
+        if new:
+            _reserveIds(Session, [sesh.key for sesh in new])
+            api._saveSessions(c_key, new)
+        job.created += len(new)
+        job.skipped += len(by_key) - len(new)
+
+
+def exportPage(kind='conference', cursor=None):
+    """Return one page of the export as (lines, next_kind, next_cursor).
+
+    next_kind is None once everything has been exported; otherwise pass
+    it and next_cursor back to get the following page.
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError('kind must be one of %s.' % ', '.join(EXPORT_KINDS))
+    model = Conference if kind == 'conference' else Session
+    start = ndb.Cursor(urlsafe=cursor) if cursor else None
+    entities, next_cursor, more = model.query().fetch_page(
+        EXPORT_PAGE_SIZE, start_cursor=start)
+    lines = [json.dumps(_exportRecord(kind, entity)) for entity in entities]
+    if more and next_cursor:
+        return lines, kind, next_cursor.urlsafe()
+    if kind == 'conference':
+        return lines, 'session', None
+    return lines, None, None
+
+
+def _exportRecord(kind, entity):
+    """Return the import record for a Conference or Session."""
+    if kind == 'conference':
+        form = mapperFor(Conference, ConferenceForm).copy(entity)
+    else:
+        form = mapperFor(Session, SessionForm).copy(entity)
+    record = json.loads(protojson.encode_message(form))
+    # unset dates and times would otherwise export as the string 'None'
+    for name in entity._properties:
+        if name in record and getattr(entity, name) is None:
+            del record[name]
+    record['kind'] = kind
+    record['id'] = unicode(entity.key.id())
+    if kind == 'session':
+        record['conference'] = unicode(entity.key.parent().id())
+        record['websafeConferenceKey'] = entity.key.parent().urlsafe()
+        if entity.startTime:
+            # the format _sessionFromForm accepts
+            record['startTime'] = entity.startTime.strftime('%H:%M')
+    return record
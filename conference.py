@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 from datetime import datetime
+import hashlib
+import json
+import logging
+import operator
+import random
+import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
+from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
@@ -15,19 +25,31 @@ from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
+from models import AnnouncementForm
+from models import AnnouncementItemForm
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForms
+from models import Registration
+from models import RegistrationResultForm
 from models import TeeShirtSize
+from models import SeatShard
 from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import SessionType
 from models import SessionTypeForm
 from models import SessionKeyForm
+from models import SessionQueryForms
+from models import SessionQueryResultForm
+from models import Speaker
+from models import SpeakerIndex
 from models import SpeakerMessage
+from models import Waitlist
+from models import WaitlistEntry
+from models import WishlistEntry
 
 
 from settings import WEB_CLIENT_ID
@@ -35,14 +57,63 @@ from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
+import instrumentation
+from mappers import mapperFor
+import search
 from utils import getUserId
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-MEMCACHE_FT_SPEAKER_KEY = "FEATURED_SPEAKERS"
+MEMCACHE_FT_SPEAKER_KEY = "FEATURED_SPEAKER:%s"
+MEMCACHE_CONF_VERSION_KEY = "CONFERENCE_VERSION:%s"
+MEMCACHE_CONF_KEY = "CONFERENCE:%s:%s"
+MEMCACHE_CONF_SESSIONS_KEY = "CONFERENCE_SESSIONS:%s:%s"
+CONF_CACHE_TTL = 60 * 60
+MEMCACHE_CONF_QUERY_GEN_KEY = "CONFERENCE_QUERY_GENERATION"
+MEMCACHE_CONF_QUERY_KEY = "CONFERENCE_QUERY:%s:%s"
+CONF_QUERY_CACHE_TTL = 10 * 60
+MEMCACHE_SEARCH_KEY = "SEARCH:%s"
+# ranked results are reused for paging and repeat searches this long
+SEARCH_CACHE_TTL = 60
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_MAX_SEATS = 5
+ANNOUNCEMENT_CAS_RETRIES = 5
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# search matches are ranked together in windows of this many
+MAX_SEARCH_CANDIDATES = 200
+ORGANIZER_NAME_BATCH_SIZE = 100
+MIGRATION_BATCH_SIZE = 100
+SEAT_SHARDS = 10
+MAX_SESSIONS_PER_BATCH = 500
+DEFAULT_EARLY_CUTOFF = 19 * 60
+# Properties read by projection queries for list views; each needs a
+# matching index in index.yaml
+CONF_LIST_PROJECTION = ('city', 'name', 'startDate')
+SESSION_LIST_PROJECTION = ('date', 'name', 'speaker', 'startTime')
+SEAT_SYNC_DELAY = 10
+# Each promotion transaction touches the SEAT_SHARDS shards, the Waitlist
+# and one Profile entity group per user, within the 25 group XG limit
+WAITLIST_PROMOTE_BATCH = 10
+WAITLIST_BATCHES_PER_TASK = 10
+# Confirmation emails are queued on a pull queue (see queue.yaml) and
+# sent in batches by the /crons/send_confirmation_emails job
+CONFIRMATION_EMAIL_QUEUE = 'confirmation-email'
+CONFIRMATION_EMAIL_BATCH_SIZE = 100
+CONFIRMATION_EMAIL_LEASE_SECONDS = 60
+CONFIRMATION_EMAIL_RUN_SECONDS = 50
+CONFIRMATION_EMAILS_PER_SECOND = 5
+MEMCACHE_CONFIRMATION_SENT_KEY = "CONFIRMATION_SENT:"
+CONFIRMATION_SENT_TTL = 24 * 60 * 60
+CONFIRMATION_EMAIL_TPL = ('Hi, you have created the following '
+                          'conference%s:\r\n\r\n%s')
+CONFIRMATION_ITEM_TPL = ('%(name)s\r\n'
+                         '    City: %(city)s\r\n'
+                         '    Dates: %(startDate)s - %(endDate)s\r\n'
+                         '    Topics: %(topics)s\r\n'
+                         '    Max attendees: %(maxAttendees)s\r\n')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -67,6 +138,38 @@ FIELDS = {
             'MONTH': 'month',
             'MAX_ATTENDEES': 'maxAttendees',
 }
+SESSION_FIELDS = {
+    'TYPE': 'typeOfSession',
+    'SPEAKER': 'speakerKey',
+    'DATE': 'date',
+    'START_TIME': 'startMinuteOfDay',
+    'DURATION': 'durationInMin',
+}
+# Higher is more selective; used to rank query plans
+SESSION_FIELD_SELECTIVITY = {
+    'speakerKey': 4,
+    'date': 3,
+    'startMinuteOfDay': 2,
+    'durationInMin': 2,
+    'typeOfSession': 1,
+}
+# Session composite indexes declared in index.yaml. All but the last
+# property take equality filters; the last takes equality or inequality.
+SESSION_INDEXES = (
+    ('typeOfSession', 'startMinuteOfDay'),
+    ('typeOfSession', 'durationInMin'),
+    ('typeOfSession', 'date'),
+    ('speakerKey', 'startMinuteOfDay'),
+    ('date', 'startMinuteOfDay'),
+)
+COMPARATORS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
 # Used in getConference and registerForConference endpoints
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -82,9 +185,21 @@ SESH_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1),
 )
+# Used in createSessions endpoint
+SESHS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
 # Used in getConferencesByTopic endpoint
 TOPIC_REQUEST = endpoints.ResourceContainer(
-    topic=messages.StringField(1)
+    topic=messages.StringField(1),
+    select=messages.StringField(2, repeated=True),
+)
+# Used in getConferencesCreated endpoint; 'select' rather than 'fields',
+# which the API frontend reserves for partial responses
+SELECT_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    select=messages.StringField(1, repeated=True),
 )
 # Used in getConferenceSessions enpoint
 SESH_REQUEST = endpoints.ResourceContainer(
@@ -96,6 +211,30 @@ SESH_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     stype=messages.StringField(2),
 )
 
+# Used in searchConferences endpoint
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+# Used in searchSessions endpoint
+SESH_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    websafeConferenceKey=messages.StringField(4),
+)
+# Used in getEarlyNonWorkshopSessions endpoint
+EARLY_SESH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    before=messages.StringField(1),
+    excludeTypes=messages.StringField(2, repeated=True),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 @endpoints.api(
                name='conference',
@@ -116,66 +255,317 @@ class ConferenceApi(remote.Service):
 
     def _copySessionToForm(self, sesh):
         """Copy all relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sesh, field.name):
-                # If field is date or startTime, convert to string.
-                if field.name in('date', 'startTime'):
-                    setattr(sf, field.name, str(getattr(sesh, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sesh, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, sesh.key.urlsafe())
-        sf.check_initialized()
-        return sf
-
-    def _createSession(self, request):
-        """Creates a session in the database"""
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        conf = c_key.get()
-
-        # User must be logged in
-        if endpoints.get_current_user() is None:
-            raise endpoints.UnauthorizedException('Must be logged in to create a session.')
-        # Validate that the person creating the
-        # session is the conference organiser.
-        if conf.organizerUserId != getUserId(endpoints.get_current_user()):
+        return mapperFor(Session, SessionForm).copy(sesh)
+
+    def _requireLogin(self, action):
+        """Raise unless a user is logged in; action completes the message,
+        e.g. 'create a session'."""
+        if self._currentUser() is None:
+            raise endpoints.UnauthorizedException(
+                'Must be logged in to %s.' % action)
+
+    def _getOrganizedConference(self, c_key, action):
+        """Return the conference, checking the user is its organizer."""
+        self._requireLogin(action)
+        return self._checkOrganizer(c_key, c_key.get(), action)
+
+    def _checkOrganizer(self, c_key, conf, action):
+        """Return conf, checking it exists and the user is its organizer."""
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % c_key.urlsafe())
+        # Validate that the person changing the
+        # sessions is the conference organiser.
+        if conf.organizerUserId != self._currentUserId():
             raise endpoints.ForbiddenException(
-                'You must be the organizer to create a session.')
+                'You must be the organizer to %s.' % action)
+        return conf
+
+    def _sessionFromForm(self, form):
+        """Validate a SessionForm and copy it into a new, unkeyed Session."""
         # If sessionType was supplied, make sure it is valid
-        if request.typeOfSession:
-            if request.typeOfSession not in SessionType.to_dict():
+        if form.typeOfSession:
+            if form.typeOfSession not in SessionType.to_dict():
                 raise endpoints.BadRequestException('Not a valid Session Type.')
 
-        # Allocate and ID for the session
-        # and set its parent to the conference
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
         session = Session()
-        session.key = s_key
-
         # Copy request fields into session object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        for field in form.all_fields():
+            if field.name in ('websafeKey', 'websafeConferenceKey'):
+                continue
+            data = getattr(form, field.name)
             # only copy fields where we get data
             if data not in (None, []):
-                # special handling for dates (convert string to Date)
-                if field.name == 'date':
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
-                if field.name == 'startTime':
-                    data = datetime.strptime(data, "%H:%M").time()
-                # write to Conference object
+                try:
+                    # special handling for dates (convert string to Date)
+                    if field.name == 'date':
+                        data = datetime.strptime(data, "%Y-%m-%d").date()
+                    if field.name == 'startTime':
+                        data = datetime.strptime(data, "%H:%M").time()
+                except ValueError:
+                    raise endpoints.BadRequestException(
+                        'Invalid %s: %s' % (field.name, data))
+                # write to Session object
                 setattr(session, field.name, data)
+        if not session.speaker.strip():
+            raise endpoints.BadRequestException('Speaker name required.')
+        session.speakerKey = self._speakerKey(session.speaker)
+        return session
 
-        session.put()
-        taskqueue.add(params={'wsck': c_key.urlsafe(),
-                              'speaker': session.speaker},
-                      url='/tasks/set_ft_speaker'
-                      )
+    def _createSession(self, request):
+        """Creates a session in the database"""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        self._requireLogin('create a session')
+        session = self._sessionFromForm(request)
+
+        # Load the conference and allocate an ID for the session, parented
+        # to the conference, concurrently
+        conf_future = c_key.get_async()
+        ids_future = Session.allocate_ids_async(size=1, parent=c_key)
+        self._checkOrganizer(c_key, conf_future.get_result(),
+                             'create a session')
+        s_id = ids_future.get_result()[0]
+        session.key = ndb.Key(Session, s_id, parent=c_key)
+
+        self._saveSessions(c_key, [session])
         return self._copySessionToForm(session)
 
+    def _createSessions(self, request):
+        """Creates a batch of sessions in the database"""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        if not request.items:
+            raise endpoints.BadRequestException('No sessions supplied.')
+        if len(request.items) > MAX_SESSIONS_PER_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once.'
+                % MAX_SESSIONS_PER_BATCH)
+        self._requireLogin('create sessions')
+        # validate every session before writing any of them
+        sessions = [self._sessionFromForm(form) for form in request.items]
+
+        # Allocate all IDs in one call, parented to the conference, while
+        # the conference loads
+        conf_future = c_key.get_async()
+        ids_future = Session.allocate_ids_async(size=len(sessions),
+                                                parent=c_key)
+        self._checkOrganizer(c_key, conf_future.get_result(),
+                             'create sessions')
+        first, last = ids_future.get_result()
+        for s_id, session in zip(range(first, last + 1), sessions):
+            session.key = ndb.Key(Session, s_id, parent=c_key)
+
+        self._saveSessions(c_key, sessions)
+        return SessionForms(
+            items=[self._copySessionToForm(sesh) for sesh in sessions]
+        )
+
+    @staticmethod
+    def _getSpeakerIndex(c_key):
+        """Return the conference's SpeakerIndex, building it if missing.
+
+        Conferences whose sessions predate the index get it built from an
+        ancestor query, so call this inside a transaction before writing.
+        Indexes written before names were stored are keyed by raw speaker
+        name, so they are rebuilt the same way.
+        """
+        i_key = ndb.Key(SpeakerIndex, 'speakers', parent=c_key)
+        index = i_key.get()
+        if index is None or index.names is None:
+            index = SpeakerIndex(key=i_key, sessions={}, names={})
+            for sesh in Session.query(ancestor=c_key):
+                ConferenceApi._indexSession(index, sesh)
+        return index
+
+    @staticmethod
+    def _indexSession(index, sesh):
+        """Add a session to a SpeakerIndex under its normalized speaker."""
+        speaker_id = ConferenceApi._speakerKey(sesh.speaker).id()
+        index.sessions.setdefault(speaker_id, {})[
+            sesh.key.urlsafe()] = sesh.name
+        index.names.setdefault(speaker_id,
+                               ConferenceApi._speakerName(sesh.speaker))
+
+    @staticmethod
+    def _unindexSession(index, sesh):
+        """Remove a session from a SpeakerIndex."""
+        speaker_id = ConferenceApi._speakerKey(sesh.speaker).id()
+        speaker_sessions = index.sessions.get(speaker_id, {})
+        speaker_sessions.pop(sesh.key.urlsafe(), None)
+        if not speaker_sessions:
+            index.sessions.pop(speaker_id, None)
+            index.names.pop(speaker_id, None)
+
+    @staticmethod
+    def _featuredSpeakerFromIndex(index):
+        """Return the featured speaker announcement for a SpeakerIndex.
+
+        The featured speaker is whoever has the most sessions, provided
+        they have more than one; otherwise the announcement is empty.
+        """
+        if not index.sessions:
+            return ''
+        speaker_id, sessions = max(sorted(index.sessions.items()),
+                                   key=lambda item: len(item[1]))
+        if len(sessions) < 2:
+            return ''
+        names = sorted(sessions.values())
+        # Format name list with commas and period at end.
+        return '%s is speaking at %s, and %s.' % (
+            index.names.get(speaker_id, speaker_id),
+            ', '.join(names[:-1]), names[-1])
+
+    @staticmethod
+    def _storeSpeakerIndex(index):
+        """Write a SpeakerIndex and refresh the cached featured speaker
+        once the surrounding transaction commits."""
+        index.put()
+        wsck = index.key.parent().urlsafe()
+        featured = ConferenceApi._featuredSpeakerFromIndex(index)
+        ConferenceApi._bumpConferenceCache(wsck)
+        ndb.get_context().call_on_commit(
+            lambda: memcache.set(MEMCACHE_FT_SPEAKER_KEY % wsck, featured))
+
+    def _saveSessions(self, c_key, sessions):
+        """Write keyed sessions of one conference and index their speakers."""
+        self._saveSessionsAsync(c_key, sessions).get_result()
+
+    @ndb.tasklet
+    def _saveSessionsAsync(self, c_key, sessions):
+        """Run the session transaction and the Speaker updates concurrently.
+
+        A Speaker may briefly list a session whose transaction then fails;
+        readers skip missing sessions.
+        """
+        yield (self._putSessionsAndIndex(c_key, sessions),
+               self._addSpeakerSessionsAsync(sessions))
+
+    @ndb.transactional_async()
+    def _putSessionsAndIndex(self, c_key, sessions):
+        """Write sessions, their SpeakerIndex entries and search
+        documents atomically."""
+        index = self._getSpeakerIndex(c_key)
+        for sesh in sessions:
+            self._indexSession(index, sesh)
+        ndb.put_multi(sessions + [self._sessionSearchDocument(sesh)
+                                  for sesh in sessions])
+        self._storeSpeakerIndex(index)
+
+    def _deleteSession(self, s_key):
+        """Delete a session and drop it from its conference's and speaker's
+        indexes."""
+        sesh = self._deleteSessionAndUnindex(s_key)
+        if not sesh:
+            return False
+        self._removeSpeakerSession(sesh.speakerKey or
+                                   self._speakerKey(sesh.speaker), s_key)
+        return True
+
+    @ndb.transactional()
+    def _deleteSessionAndUnindex(self, s_key):
+        """Delete a session, its SpeakerIndex entry and search document
+        atomically."""
+        sesh = s_key.get()
+        if not sesh:
+            return None
+        index = self._getSpeakerIndex(s_key.parent())
+        self._unindexSession(index, sesh)
+        ndb.delete_multi([s_key, search.documentKey(s_key)])
+        self._storeSpeakerIndex(index)
+        return sesh
+
+    @staticmethod
+    def _speakerKey(name):
+        """Return the Speaker key for a name, normalized for case and
+        whitespace."""
+        return ndb.Key(Speaker, ConferenceApi._speakerName(name).lower())
+
+    @staticmethod
+    def _speakerName(name):
+        """Return a speaker name for display, with whitespace collapsed."""
+        return ' '.join(name.split())
+
+    @staticmethod
+    def _addSpeakerSessions(sessions):
+        """Record sessions on their Speaker entities."""
+        ConferenceApi._addSpeakerSessionsAsync(sessions).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def _addSpeakerSessionsAsync(sessions):
+        """Record sessions on their Speaker entities, one concurrent
+        transaction per speaker."""
+        by_speaker = {}
+        for sesh in sessions:
+            by_speaker.setdefault(sesh.speakerKey, []).append(sesh)
+        yield [ConferenceApi._addSpeakerSessionKeys(
+            sp_key, speaker_sessions[0].speaker,
+            [sesh.key for sesh in speaker_sessions])
+            for sp_key, speaker_sessions in by_speaker.items()]
+
+    @staticmethod
+    @ndb.transactional_async()
+    def _addSpeakerSessionKeys(sp_key, name, s_keys):
+        """Add session keys to a Speaker, creating it if needed."""
+        speaker = sp_key.get() or Speaker(
+            key=sp_key, name=ConferenceApi._speakerName(name))
+        known = set(speaker.sessionKeys)
+        speaker.sessionKeys.extend(
+            s_key for s_key in s_keys if s_key not in known)
+        speaker.put()
+
+    @staticmethod
+    @ndb.transactional()
+    def _removeSpeakerSession(sp_key, s_key):
+        """Remove a session key from a Speaker."""
+        speaker = sp_key.get()
+        if speaker and s_key in speaker.sessionKeys:
+            speaker.sessionKeys.remove(s_key)
+            speaker.put()
+
+    @staticmethod
+    def _migrateSpeakers(cursor=None):
+        """Link one batch of Sessions to Speaker entities.
+
+        Sets speakerKey on each Session and records it on its Speaker, and
+        rebuilds legacy SpeakerIndex entities of their conferences; the
+        re-put also indexes computed Session properties. Safe to re-run.
+        Chains a task for the next batch until done.
+        """
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=start)
+        for sesh in sessions:
+            sesh.speakerKey = ConferenceApi._speakerKey(sesh.speaker)
+        ndb.put_multi(sessions)
+        ConferenceApi._addSpeakerSessions(sessions)
+        for c_key in set(sesh.key.parent() for sesh in sessions):
+            ConferenceApi._migrateSpeakerIndex(c_key)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/migrate_speakers'
+                          )
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateSpeakerIndex(c_key):
+        """Rebuild a conference's SpeakerIndex if it is keyed by raw
+        speaker name."""
+        index = ndb.Key(SpeakerIndex, 'speakers', parent=c_key).get()
+        if index is not None and index.names is None:
+            ConferenceApi._storeSpeakerIndex(
+                ConferenceApi._getSpeakerIndex(c_key))
+
     def _getConferenceSessions(self, websafeConferenceKey, stype=None):
         """Returns sessions in a given conference with optional type filter"""
+        # the unfiltered list is served from the conference cache
+        if not stype:
+            return self._readThroughConferenceCache(
+                websafeConferenceKey, MEMCACHE_CONF_SESSIONS_KEY, SessionForms,
+                lambda: self._querySessionForms(websafeConferenceKey))
+        return self._querySessionForms(websafeConferenceKey, stype)
+
+    def _querySessionForms(self, websafeConferenceKey, stype=None):
+        """Query sessions in a given conference with optional type filter"""
         c_key = ndb.Key(urlsafe=websafeConferenceKey)
         sessions = Session.query(ancestor=c_key)
 
@@ -203,7 +593,9 @@ class ConferenceApi(remote.Service):
 
         sessions = Session.query(Session.typeOfSession == stype)
         return SessionForms(
-            items=[self._copySessionToForm(sesh) for sesh in sessions]
+            items=self._listForms(sessions, request.select, SessionForm,
+                                  SESSION_LIST_PROJECTION,
+                                  self._copySessionToForm)
         )
 
     @endpoints.method(TOPIC_REQUEST, ConferenceForms,
@@ -215,8 +607,9 @@ class ConferenceApi(remote.Service):
 
         conferences = Conference.query(Conference.topics == topic)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(
-                conf, "") for conf in conferences]
+            items=self._listForms(conferences, request.select, ConferenceForm,
+                                  CONF_LIST_PROJECTION,
+                                  self._copyConferenceToForm)
         )
 
     @endpoints.method(SESH_POST_REQUEST, SessionForm,
@@ -226,6 +619,24 @@ class ConferenceApi(remote.Service):
         """Create a session if user is organizer of the conference"""
         return self._createSession(request)
 
+    @endpoints.method(SESHS_POST_REQUEST, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions/batch',
+                      http_method='POST', name='createSessions')
+    def createSessions(self, request):
+        """Create a batch of sessions if user is organizer of the conference"""
+        return self._createSessions(request)
+
+    @endpoints.method(SessionKeyForm, BooleanMessage,
+                      path='session', http_method='DELETE',
+                      name='deleteSession')
+    def deleteSession(self, request):
+        """Delete a session if user is organizer of its conference"""
+        s_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        if s_key.kind() != 'Session':
+            raise endpoints.BadRequestException('websafeKey provided is not a session key.')
+        self._getOrganizedConference(s_key.parent(), 'delete a session')
+        return BooleanMessage(data=self._deleteSession(s_key))
+
     @endpoints.method(SESH_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='getConferenceSessions')
@@ -248,131 +659,279 @@ class ConferenceApi(remote.Service):
                       http_method='GET')
     def getSessionsBySpeaker(self, request):
         """Given a speaker by name, return all sessions he/she is speaking at"""
-        speaker = request.speaker
-        sessions = Session.query(Session.speaker == speaker)
+        speaker = self._speakerKey(request.speaker).get()
+        sessions = ndb.get_multi(speaker.sessionKeys) if speaker else []
         return SessionForms(
-            items=[self._copySessionToForm(sesh) for sesh in sessions]
+            items=[self._copySessionToForm(sesh) for sesh in sessions if sesh]
         )
 
 # - - - - - - - - - - Query Problem Code - - - - - - - - - - - - - -
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(EARLY_SESH_REQUEST, SessionForms,
                        path='nonworkshop', name='getEarlyNonWorkshopSessions',
                        http_method='GET')
     def getEarlyNonWorkshopSessions(self, request):
-        """Queries for all sessions before 7:00PM that are not Workshops"""
-        sessions = Session.query(
-                        ndb.AND(
-           ndb.OR(Session.typeOfSession == 'NOT_SPECIFIED',
-               Session.typeOfSession == 'KEYNOTE',
-               Session.typeOfSession == 'FREEFORM',
-               Session.typeOfSession == 'LECTURE',
-                                ), Session.startTime < datetime.strptime('19:00', '%H:%M').time())
-           )
+        """Queries for sessions starting before a cutoff (default 7:00PM)
+        that are not of the excluded types (default Workshops)"""
+        cutoff = DEFAULT_EARLY_CUTOFF
+        if request.before:
+            try:
+                before = datetime.strptime(request.before, '%H:%M')
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'before must be formatted as HH:MM.')
+            cutoff = before.hour * 60 + before.minute
+
+        excluded = set(request.excludeTypes or ['WORKSHOP'])
+        if not excluded.issubset(SessionType.to_dict()):
+            raise endpoints.BadRequestException('Not a valid Session Type.')
+
+        # a single index scan on (isWorkshop, startMinuteOfDay); any other
+        # excluded types are skipped in memory, reading on to fill the page
+        sessions = Session.query(Session.startMinuteOfDay < cutoff)
+        if 'WORKSHOP' in excluded:
+            sessions = sessions.filter(Session.isWorkshop == False)
+        sessions = sessions.order(Session.startMinuteOfDay)
+        excluded.discard('WORKSHOP')
+
+        keep = None
+        if excluded:
+            keep = lambda sesh: sesh.typeOfSession not in excluded
+        sessions, next_token = self._fetchPage(sessions, request, keep)
         return SessionForms(
-            items=[self._copySessionToForm(sesh) for sesh in sessions]
+            items=[self._copySessionToForm(sesh) for sesh in sessions],
+            nextPageToken=next_token
+        )
+
+# - - - - - - - - - - Generic Session Query - - - - - - - - - - - - -
+
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and convert user supplied session filters."""
+        formatted_filters = []
+        for f in filters:
+            try:
+                field = SESSION_FIELDS[f.field]
+                op = OPERATORS[f.operator]
+            except KeyError:
+                raise endpoints.BadRequestException(
+                    "Filter contains invalid field or operator.")
+            try:
+                if field == 'typeOfSession':
+                    if f.value not in SessionType.to_dict():
+                        raise ValueError(f.value)
+                    value = f.value
+                elif field == 'speakerKey':
+                    value = self._speakerKey(f.value)
+                elif field == 'date':
+                    value = datetime.strptime(f.value, "%Y-%m-%d").date()
+                elif field == 'startMinuteOfDay':
+                    start = datetime.strptime(f.value, "%H:%M")
+                    value = start.hour * 60 + start.minute
+                else:
+                    value = int(f.value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Invalid value for %s: %s" % (f.field, f.value))
+            formatted_filters.append(
+                {'field': field, 'operator': op, 'value': value})
+        return formatted_filters
+
+    def _planSessionQuery(self, filters):
+        """Pick the filters to run in the datastore for a session query.
+
+        Every declared composite index, and the built-in single property
+        indexes, is scored by how many filters it can serve and how
+        selective they are. '!=' is never pushed down since ndb would
+        fan it out into two queries.
+
+        Returns a tuple of (pushed filters, in-memory filters, plan).
+        """
+        equality = [f for f in filters if f['operator'] == '=']
+        inequality = [f for f in filters if f['operator'] not in ('=', '!=')]
+
+        def served(field, allow_inequality):
+            pushed = [f for f in equality if f['field'] == field][:1]
+            if allow_inequality and not pushed:
+                pushed = [f for f in inequality if f['field'] == field]
+            return pushed
+
+        # (pushed filters, description) for every usable index
+        candidates = []
+        for field in set(f['field'] for f in equality + inequality):
+            candidates.append((served(field, True),
+                               'built-in index on %s' % field))
+        for index in SESSION_INDEXES:
+            pushed = []
+            for field in index[:-1]:
+                pushed.extend(served(field, False))
+            if len(pushed) != len(index) - 1:
+                continue
+            last = served(index[-1], True)
+            if last:
+                candidates.append((pushed + last, 'composite index on '
+                                   'Session(%s)' % ', '.join(index)))
+
+        if not candidates:
+            candidates = [([], 'kind scan of Session')]
+        pushed, plan = max(candidates, key=lambda c: (
+            len(c[0]), sum(SESSION_FIELD_SELECTIVITY[f['field']]
+                           for f in c[0])))
+        remaining = [f for f in filters if f not in pushed]
+        if remaining:
+            plan += '; in memory: %s' % ', '.join(
+                '%s %s' % (f['field'], f['operator']) for f in remaining)
+        return pushed, remaining, plan
+
+    @endpoints.method(SessionQueryForms, SessionQueryResultForm,
+                      path='querySessions', http_method='POST',
+                      name='querySessions')
+    def querySessions(self, request):
+        """Query sessions by type, speaker, date, startTime and duration."""
+        filters = self._formatSessionFilters(request.filters)
+        pushed, remaining, plan = self._planSessionQuery(filters)
+
+        # build filters through the model properties so values get the
+        # same conversion as on write (e.g. dates stored as datetimes)
+        q = Session.query()
+        for filtr in pushed:
+            q = q.filter(Session._properties[filtr['field']]._comparison(
+                filtr['operator'], filtr['value']))
+        # an inequality filter must be the first sort order
+        inequality_fields = [f['field'] for f in pushed if f['operator'] != '=']
+        if inequality_fields:
+            q = q.order(Session._properties[inequality_fields[0]])
+
+        # the in-memory filters are applied as results are read, reading
+        # on until the page is full
+        keep = None
+        if remaining:
+            keep = lambda sesh: all(
+                getattr(sesh, f['field']) is not None and
+                COMPARATORS[f['operator']](getattr(sesh, f['field']),
+                                           f['value'])
+                for f in remaining)
+        sessions, next_token = self._fetchPage(q, request, keep)
+        return SessionQueryResultForm(
+            items=[self._copySessionToForm(sesh) for sesh in sessions],
+            nextPageToken=next_token,
+            queryPlan=plan
         )
 
 ####################################################################
 # - - - - - - - - - - Code for Final Task 4 - - - - - - - - - - - -
 ####################################################################
-    @ndb.transactional
+    @staticmethod
+    def _wishlistKey(p_key, wssk):
+        """Return the WishlistEntry key for a Profile and session."""
+        return ndb.Key(WishlistEntry, wssk, parent=p_key)
+
+    @staticmethod
+    def _getWishlistSessionKeys(p_key):
+        """Return the keys of the sessions in a Profile's wishlist."""
+        return [ndb.Key(urlsafe=w_key.id()) for w_key in
+                WishlistEntry.query(ancestor=p_key).fetch(keys_only=True)]
+
     @endpoints.method(SessionKeyForm, SessionForm,
                       path='wishlist', name='addSessionToWishlist',
                       http_method='POST')
     def addSessionToWishlist(self, request):
         """Add session to user's wishlist - takes sessionkey"""
         wssk = request.websafeSessionKey
-        sesh = ndb.Key(urlsafe=wssk).get()
-        profile = self._getProfileFromUser()
+        s_key = ndb.Key(urlsafe=wssk)
 
         # Raise exception if wssk is not a session key
-        if ndb.Key(urlsafe=wssk).kind() != 'Session':
+        if s_key.kind() != 'Session':
             raise endpoints.BadRequestException('websafeKey provided is not a session key.')
+        # the session and profile gets are batched into one RPC
+        sesh_future = s_key.get_async()
+        profile = self._getProfileFromUser()
+        sesh = sesh_future.get_result()
         # Raise exception if session does not exist
         if not sesh:
             raise endpoints.BadRequestException('Session key does not exist.')
-        # Raise exception if session already in user's wishlist
-        if wssk in profile.sessionKeysWishlist:
-            raise endpoints.BadRequestException('Session key already in wishlist')
 
-        profile.sessionKeysWishlist.append(wssk)
-        profile.put()
+        # Keyed by session, so adding it again just rewrites the entry
+        WishlistEntry(key=self._wishlistKey(profile.key, wssk),
+                      session=s_key).put()
 
         return self._copySessionToForm(sesh)
 
+    @endpoints.method(SessionKeyForm, BooleanMessage,
+                      path='wishlist', name='removeSessionFromWishlist',
+                      http_method='DELETE')
+    def removeSessionFromWishlist(self, request):
+        """Remove session from user's wishlist - takes sessionkey"""
+        profile = self._getProfileFromUser()
+        w_key = self._wishlistKey(profile.key, request.websafeSessionKey)
+        # report whether it was there; deleting a missing entry is a no-op
+        existed = w_key.get() is not None
+        w_key.delete()
+        return BooleanMessage(data=existed)
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='wishlist', name='getSessionsFromWishlist',
                       http_method='GET')
     def getSessionsFromWishlist(self, unused_request):
         """Returns list of sessions based on user's wishlist"""
         profile = self._getProfileFromUser()
-        sesh_keys = [ndb.Key(urlsafe=wssk)
-                     for wssk in profile.sessionKeysWishlist]
-        sessions = ndb.get_multi(sesh_keys)
+        sessions = ndb.get_multi(self._getWishlistSessionKeys(profile.key))
         return SessionForms(
-            items=[self._copySessionToForm(sesh) for sesh in sessions]
+            items=[self._copySessionToForm(sesh) for sesh in sessions if sesh]
         )
 # - - - - - - - Task 4 Code - - - - - - - - - - - - - - - - - - - -
-    @staticmethod
-    def _cacheFeaturedSpeaker(wsck, speaker):
-        """
-        Checks if speaker is speaking at multiple sessions in given 
-        conference and caches him/her has featured speaker if true.
-        """
-        seshlist = Session.query(ancestor=ndb.Key(urlsafe=wsck))\
-                   .filter(Session.speaker == speaker).fetch()
-        seshNames = ""
-        # If two or more sessions with speaker name
-        ftSpeaker = None
-        ftSpeakerStr = ''
-        if len(seshlist) > 1:
-            # Format name list with commas and period at end.
-            for cnt, sesh in enumerate(seshlist):
-                if cnt < len(seshlist) - 1:
-                    seshNames += "{}, ".format(sesh.name)
-                else:
-                    seshNames += "and {}.".format(sesh.name)
-            ftSpeakerStr = '%s is speaking at %s' % (speaker, seshNames)
-            # Add speaker to memcache
-            memcache.add(key=MEMCACHE_FT_SPEAKER_KEY, value=ftSpeakerStr)
-        return ftSpeakerStr
-
-    @endpoints.method(message_types.VoidMessage, StringMessage,
-                      path='speaker/featured/get',
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+                      path='conference/{websafeConferenceKey}/featuredspeaker',
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return featured speaker from memcache"""
-        return StringMessage(data=memcache.get(MEMCACHE_FT_SPEAKER_KEY or ""))
+        """Return the featured speaker of a conference"""
+        wsck = request.websafeConferenceKey
+        featured = memcache.get(MEMCACHE_FT_SPEAKER_KEY % wsck)
+        if featured is None:
+            # fall back to the stored index and repopulate memcache
+            featured = self._featuredSpeakerFromIndex(
+                self._getSpeakerIndex(ndb.Key(urlsafe=wsck)))
+            memcache.set(MEMCACHE_FT_SPEAKER_KEY % wsck, featured)
+        return StringMessage(data=featured)
 
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return mapperFor(Conference, ConferenceForm).copy(conf)
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
+        user = self._currentUser()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._currentUserId()
+        conf = self._conferenceFromForm(
+            request, user_id, self._getProfileFromUser().displayName)
+
+        # generate Profile Key based on user ID and Conference
+        # ID based on Profile key get Conference key from ID
+        p_key = ndb.Key(Profile, user_id)
+        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        conf.key = ndb.Key(Conference, c_id, parent=p_key)
+
+        # create Conference and its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        conf.put()
+        self._bumpConferenceQueryCache()
+        ndb.put_multi(self._newConferenceEntities(conf))
+        self._queueConfirmationEmail(user.email(), conf.key.urlsafe(),
+                                     request)
+        return request
+
+    def _conferenceFromForm(self, request, user_id, display_name):
+        """Validate a ConferenceForm and copy it into a new, unkeyed
+        Conference.
 
+        Defaults and organizer fields are filled in on request as well,
+        so it can be returned as the created conference.
+        """
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
@@ -381,7 +940,6 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
 
         # add default values for those missing (both data model & outbound
         # Message)
@@ -392,42 +950,44 @@ class ConferenceApi(remote.Service):
 
         # convert dates from strings to Date objects; set month based on
         # start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(
-                data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(
-                data['endDate'][:10], "%Y-%m-%d").date()
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(
+                    data['startDate'][:10], "%Y-%m-%d").date()
+                data['month'] = data['startDate'].month
+            else:
+                data['month'] = 0
+            if data['endDate']:
+                data['endDate'] = datetime.strptime(
+                    data['endDate'][:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Dates must be formatted YYYY-MM-DD.')
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        # denormalize the organizer's name so reads don't need the Profile
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            display_name
+        return Conference(**data)
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
-        return request
+    @staticmethod
+    def _newConferenceEntities(conf):
+        """Return the seat shards and search document for a new Conference."""
+        return [SeatShard(key=key, conference=conf.key, seatsAvailable=seats)
+                for key, seats in zip(
+                    ConferenceApi._seatShardKeys(conf.key),
+                    ConferenceApi._splitSeats(conf.seatsAvailable))] + \
+            [ConferenceApi._conferenceSearchDocument(conf)]
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
+        user = self._currentUser()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._currentUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
@@ -447,7 +1007,12 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        old_max = conf.maxAttendees or 0
         for field in request.all_fields():
+            # organizerDisplayName is maintained from the Profile and
+            # seatsAvailable is derived from the seat shards
+            if field.name in ('organizerDisplayName', 'seatsAvailable'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -458,9 +1023,16 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # grow or shrink the seat shards with maxAttendees
+        delta = (conf.maxAttendees or 0) - old_max
+        if delta:
+            conf.seatsAvailable = self._adjustSeats(conf, delta)
+            if delta > 0:
+                self._enqueueWaitlistPromotion(request.websafeConferenceKey)
+        ndb.put_multi([conf, self._conferenceSearchDocument(conf)])
+        self._bumpConferenceCache(request.websafeConferenceKey)
+        self._bumpConferenceQueryCache()
+        return conf
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
@@ -473,40 +1045,96 @@ class ConferenceApi(remote.Service):
                       http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf = self._updateConferenceObject(request)
+        # after the commit, not from call_on_commit: that still runs in
+        # the finished transaction, where a rebuild's non-ancestor query
+        # fails, and uncommitted seats or names must not reach memcache
+        self._updateAnnouncement(conf, conf.seatsAvailable)
+        return self._copyConferenceToForm(conf)
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        return self._readThroughConferenceCache(
+            request.websafeConferenceKey, MEMCACHE_CONF_KEY, ConferenceForm,
+            lambda: self._getConferenceForm(request.websafeConferenceKey))
+
+    def _getConferenceForm(self, websafeConferenceKey):
+        """Return the ConferenceForm for websafeConferenceKey from datastore."""
+        # get Conference object and its seat shards in one batch; bail if
+        # not found
+        c_key = ndb.Key(urlsafe=websafeConferenceKey)
+        conf_future = c_key.get_async()
+        shard_futures = ndb.get_multi_async(self._seatShardKeys(c_key))
+        conf = conf_future.get_result()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % websafeConferenceKey)
+        # report the exact seat count from the shards rather than the
+        # periodically synced copy on the Conference
+        cf = self._copyConferenceToForm(conf)
+        shards = [future.get_result() for future in shard_futures]
+        if None not in shards:
+            cf.seatsAvailable = sum(shard.seatsAvailable for shard in shards)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @staticmethod
+    def _conferenceCacheVersion(wsck):
+        """Return the current cache version for a conference."""
+        version_key = MEMCACHE_CONF_VERSION_KEY % wsck
+        version = memcache.get(version_key)
+        if version is None:
+            memcache.add(version_key, 1)
+            version = memcache.get(version_key) or 1
+        return version
+
+    @staticmethod
+    def _bumpConferenceCache(wsck):
+        """Invalidate cached forms for a conference by bumping its version.
+
+        Inside a transaction the bump is deferred until commit, so readers
+        can't repopulate the cache with pre-commit data.
+        """
+        ndb.get_context().call_on_commit(
+            lambda: memcache.incr(MEMCACHE_CONF_VERSION_KEY % wsck,
+                                  initial_value=1))
+
+    def _readThroughConferenceCache(self, wsck, key_tpl, message_type, build):
+        """Return a cached message for a conference, building it on a miss.
+
+        key_tpl is formatted with the websafe key and cache version; build
+        is called to produce the message when it is not cached.
+        """
+        cache_key = key_tpl % (wsck, self._conferenceCacheVersion(wsck))
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return protojson.decode_message(message_type, cached)
+        message = build()
+        memcache.set(cache_key, protojson.encode_message(message),
+                     time=CONF_CACHE_TTL)
+        return message
+
+    @endpoints.method(SELECT_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
+        user = self._currentUser()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._currentUserId()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(
-                conf, getattr(prof, 'displayName')) for conf in confs]
+            items=self._listForms(confs, request.select, ConferenceForm,
+                                  CONF_LIST_PROJECTION,
+                                  self._copyConferenceToForm)
         )
 
     def _getQuery(self, request):
@@ -529,6 +1157,121 @@ class ConferenceApi(remote.Service):
             q = q.filter(formatted_query)
         return q
 
+    def _conferenceQueryCacheKey(self, request):
+        """Return the memcache key for a queryConferences page.
+
+        The key hashes the canonical (sorted) filter set and page fields,
+        and includes the query cache generation.
+        """
+        inequality_filter, filters = self._formatFilters(request.filters)
+        canonical = json.dumps({
+            'filters': sorted(
+                [f['field'], f['operator'], f['value']]
+                for f in filters),
+            'pageSize': request.pageSize or DEFAULT_PAGE_SIZE,
+            'pageToken': request.pageToken,
+        }, sort_keys=True)
+        generation = memcache.get(MEMCACHE_CONF_QUERY_GEN_KEY) or 0
+        return MEMCACHE_CONF_QUERY_KEY % (
+            generation, hashlib.sha1(canonical).hexdigest())
+
+    @staticmethod
+    def _bumpConferenceQueryCache():
+        """Invalidate all cached queryConferences pages after commit.
+
+        Only needed for writes that can change which conferences match a
+        query or their order; writes to derived fields such as
+        seatsAvailable or organizerDisplayName are picked up on hydration.
+        """
+        ndb.get_context().call_on_commit(
+            lambda: memcache.incr(MEMCACHE_CONF_QUERY_GEN_KEY,
+                                  initial_value=0))
+
+    @staticmethod
+    def _pageSize(request):
+        """Return the request's pageSize, or the default; checks bounds."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'pageSize must be between 1 and %d.' % MAX_PAGE_SIZE)
+        return page_size
+
+    def _fetchPage(self, query, request, keep=None):
+        """Fetch one page of query results using the request's page fields.
+
+        Results for which keep returns False are skipped, reading on until
+        the page is full, so a page is only short when it is the last one.
+
+        Returns a tuple of (results, nextPageToken); the token is None when
+        there are no more results.
+        """
+        page_size = self._pageSize(request)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = ndb.Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException('Invalid pageToken.')
+
+        if keep is None:
+            results, next_cursor, more = query.fetch_page(
+                page_size, start_cursor=cursor)
+            next_token = (next_cursor.urlsafe() if more and next_cursor
+                          else None)
+            return results, next_token
+
+        results = []
+        it = query.iter(start_cursor=cursor, produce_cursors=True,
+                        batch_size=page_size)
+        for entity in it:
+            if keep(entity):
+                results.append(entity)
+                if len(results) == page_size:
+                    break
+        else:
+            return results, None
+        # the cursor after the last kept result, not the batch end
+        next_token = (it.cursor_after().urlsafe() if it.probably_has_next()
+                      else None)
+        return results, next_token
+
+    def _listForms(self, query, select, form_cls, projection, copy):
+        """Run a list query, reading only what the select parameter needs.
+
+        Without select, full entities are copied with copy. Otherwise only
+        the requested (and required) form fields are filled in, reading
+        keys only when just websafeKey is wanted, a projection when the
+        fields fit in projection, or keys plus a get_multi that ndb can
+        serve from its cache.
+        """
+        if not select:
+            return [copy(entity) for entity in query]
+
+        known = set(field.name for field in form_cls.all_fields())
+        unknown = set(select) - known
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: %s' % ', '.join(sorted(unknown)))
+        fields = set(select).union(field.name for field in
+                                   form_cls.all_fields() if field.required)
+
+        wanted = fields - set(['websafeKey'])
+        if not wanted:
+            return [form_cls(websafeKey=key.urlsafe())
+                    for key in query.fetch(keys_only=True)]
+        if wanted.issubset(projection):
+            entities = query.fetch(projection=projection)
+        else:
+            entities = [entity for entity in
+                        ndb.get_multi(query.fetch(keys_only=True)) if entity]
+        return [self._copyFieldsToForm(entity, form_cls, fields)
+                for entity in entities]
+
+    def _copyFieldsToForm(self, entity, form_cls, fields):
+        """Copy the named fields from an entity, possibly a projection, to
+        a new form."""
+        return mapperFor(type(entity), form_cls).copy(entity, fields)
+
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
@@ -544,6 +1287,8 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
+            # normalise once so the query and its cache key agree
+            filtr["value"] = (filtr["value"] or '').strip()
 
             # Every operation except "=" is an inequality
             if filtr["operator"] != "=":
@@ -565,53 +1310,303 @@ class ConferenceApi(remote.Service):
                       http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time."""
+        # pages are cached as key lists and hydrated with get_multi, which
+        # ndb serves from its own cache
+        cache_key = self._conferenceQueryCacheKey(request)
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            conf_keys, next_token = cached
+            conferences = [conf for conf in ndb.get_multi(conf_keys) if conf]
+        else:
+            conferences, next_token = self._fetchPage(
+                self._getQuery(request), request)
+            memcache.set(cache_key,
+                         ([conf.key for conf in conferences], next_token),
+                         time=CONF_QUERY_CACHE_TTL)
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # return individual ConferenceForm object per Conference
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_token
+        )
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
 
-        # return individual ConferenceForm object per Conference
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _conferenceSearchDocument(conf):
+        """Return the SearchDocument indexing a Conference."""
+        return search.buildDocument(conf.key, [(conf.name, 3),
+                                               (conf.topics, 2),
+                                               (conf.city, 1),
+                                               (conf.description, 1)])
+
+    @staticmethod
+    def _sessionSearchDocument(sesh):
+        """Return the SearchDocument indexing a Session."""
+        return search.buildDocument(sesh.key, [(sesh.name, 3),
+                                               (sesh.speaker, 2),
+                                               (sesh.typeOfSession, 1),
+                                               (sesh.highlights, 1)])
+
+    def _search(self, kind, request, ancestor=None):
+        """Return (entities, nextPageToken) for one page of search results.
+
+        Matches are read in windows of MAX_SEARCH_CANDIDATES, each ranked
+        as a whole and then paged; the page token is the offset into the
+        current window and the datastore cursor that starts it, so every
+        match is reachable. A page that reaches the end of a window is
+        filled from the next one.
+        """
+        query, tokens = search.buildQuery(kind, request.q, ancestor)
+        if query is None:
+            raise endpoints.BadRequestException('Search terms required.')
+        page_size = self._pageSize(request)
+        offset, window = 0, None
+        if request.pageToken:
+            offset, _, window = request.pageToken.partition(':')
+            if not offset.isdigit():
+                raise endpoints.BadRequestException('Invalid pageToken.')
+            offset, window = int(offset), window or None
+
+        keys = []
+        done = False
+        while len(keys) < page_size and not done:
+            ranked, next_window = self._rankSearchWindow(
+                query, tokens, [kind, ancestor and ancestor.urlsafe()],
+                window)
+            taken = ranked[offset:offset + page_size - len(keys)]
+            keys.extend(taken)
+            offset += len(taken)
+            if offset >= len(ranked):
+                if next_window:
+                    offset, window = 0, next_window
+                else:
+                    done = True
+        next_token = None if done else '%d:%s' % (offset, window or '')
+        entities = ndb.get_multi(keys)
+        return [entity for entity in entities if entity], next_token
+
+    @staticmethod
+    def _rankSearchWindow(query, tokens, scope, window):
+        """Return (ranked keys, next window cursor) for the candidates
+        starting at the window cursor.
+
+        Rankings are cached for SEARCH_CACHE_TTL, so later pages do not
+        load and rank the candidates again.
+        """
+        cache_key = MEMCACHE_SEARCH_KEY % hashlib.sha1(json.dumps(
+            scope + [tokens, window])).hexdigest()
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return cached
+        try:
+            start = ndb.Cursor(urlsafe=window) if window else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException('Invalid pageToken.')
+        docs, next_cursor, more = query.fetch_page(
+            MAX_SEARCH_CANDIDATES, start_cursor=start)
+        result = (search.rank(docs, tokens),
+                  next_cursor.urlsafe() if more and next_cursor else None)
+        memcache.set(cache_key, result, time=SEARCH_CACHE_TTL)
+        return result
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+                      path='searchConferences', http_method='GET',
+                      name='searchConferences')
+    def searchConferences(self, request):
+        """Search conference names, topics, cities and descriptions."""
+        conferences, next_token = self._search('Conference', request)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in
-                   conferences]
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=next_token
         )
 
+    @endpoints.method(SESH_SEARCH_REQUEST, SessionForms,
+                      path='searchSessions', http_method='GET',
+                      name='searchSessions')
+    def searchSessions(self, request):
+        """Search session names, speakers, types and highlights,
+        optionally within one conference."""
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        sessions, next_token = self._search('Session', request, ancestor)
+        return SessionForms(
+            items=[self._copySessionToForm(sesh) for sesh in sessions],
+            nextPageToken=next_token
+        )
+
+    @staticmethod
+    def _reindexSearch(kind, cursor=None):
+        """Write SearchDocuments for one batch of Conferences or Sessions.
+
+        Indexes entities created before search existed. Safe to re-run.
+        Chains a task for the next batch, then for Sessions after
+        Conferences, until done.
+        """
+        model, build = {
+            'Conference': (Conference,
+                           ConferenceApi._conferenceSearchDocument),
+            'Session': (Session, ConferenceApi._sessionSearchDocument),
+        }[kind]
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        entities, next_cursor, more = model.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=start)
+        ndb.put_multi([build(entity) for entity in entities])
+        if more and next_cursor:
+            taskqueue.add(params={'kind': kind,
+                                  'cursor': next_cursor.urlsafe()},
+                          url='/tasks/reindex_search'
+                          )
+        elif kind == 'Conference':
+            taskqueue.add(params={'kind': 'Session'},
+                          url='/tasks/reindex_search'
+                          )
+
+
+# - - - Confirmation emails - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _queueConfirmationEmail(email, wsck, conf_form):
+        """Queue a confirmation email for a new conference."""
+        payload = {'email': email,
+                   'websafeConferenceKey': wsck,
+                   'name': conf_form.name,
+                   'city': conf_form.city,
+                   'startDate': conf_form.startDate,
+                   'endDate': conf_form.endDate,
+                   'topics': ', '.join(conf_form.topics or []),
+                   'maxAttendees': conf_form.maxAttendees}
+        taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE).add(
+            taskqueue.Task(payload=json.dumps(payload), method='PULL'))
+
+    @staticmethod
+    def _renderConfirmationEmail(confs):
+        """Return the subject and body confirming a list of conferences."""
+        if len(confs) == 1:
+            subject = 'You created a new Conference!'
+        else:
+            subject = 'You created %d new Conferences!' % len(confs)
+        body = CONFIRMATION_EMAIL_TPL % (
+            's' if len(confs) > 1 else '',
+            '\r\n'.join(CONFIRMATION_ITEM_TPL % conf for conf in confs))
+        return subject, body
+
+    @staticmethod
+    def _sendConfirmationEmails():
+        """Lease queued confirmation emails and send them in batches.
+
+        Each organizer gets one email per batch listing all of their new
+        conferences. A conference is confirmed at most once, even if its
+        task is leased again; sends are paced to
+        CONFIRMATION_EMAILS_PER_SECOND. Tasks that could not be sent are
+        left on the queue and are leased again once their lease expires.
+        Returns the number of emails sent.
+        """
+        queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        sender = 'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id())
+        interval = 1.0 / CONFIRMATION_EMAILS_PER_SECOND
+        stop_at = time.time() + CONFIRMATION_EMAIL_RUN_SECONDS
+        sent = 0
+        while time.time() < stop_at:
+            tasks = queue.lease_tasks(CONFIRMATION_EMAIL_LEASE_SECONDS,
+                                      CONFIRMATION_EMAIL_BATCH_SIZE)
+            if not tasks:
+                break
+
+            done = []
+            payloads = {}
+            for task in tasks:
+                try:
+                    payloads[task.name] = json.loads(task.payload)
+                except ValueError:
+                    logging.error('Dropping bad confirmation task %s',
+                                  task.name)
+                    done.append(task)
+            already_sent = memcache.get_multi(
+                [p['websafeConferenceKey'] for p in payloads.values()],
+                key_prefix=MEMCACHE_CONFIRMATION_SENT_KEY)
+
+            # group by recipient, dropping conferences already confirmed
+            by_email = {}
+            for task in tasks:
+                payload = payloads.get(task.name)
+                if payload is None:
+                    continue
+                wsck = payload['websafeConferenceKey']
+                if wsck in already_sent:
+                    done.append(task)
+                    continue
+                already_sent[wsck] = True
+                by_email.setdefault(payload['email'], []).append(
+                    (task, payload))
+
+            failed = False
+            for email, items in by_email.iteritems():
+                subject, body = ConferenceApi._renderConfirmationEmail(
+                    [payload for _, payload in items])
+                try:
+                    mail.send_mail(sender, email, subject, body)
+                except Exception:
+                    logging.exception('Sending confirmation to %s failed',
+                                      email)
+                    failed = True
+                    break
+                memcache.set_multi(
+                    dict((payload['websafeConferenceKey'], 1)
+                         for _, payload in items),
+                    time=CONFIRMATION_SENT_TTL,
+                    key_prefix=MEMCACHE_CONFIRMATION_SENT_KEY)
+                done.extend(task for task, _ in items)
+                sent += 1
+                time.sleep(interval)
+
+            if done:
+                queue.delete_tasks(done)
+            if failed:
+                break
+        return sent
+
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(
-                        pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        # teeShirtSize is converted from its string to the Enum
+        return mapperFor(Profile, ProfileForm).copy(prof)
+
+    def _currentUser(self):
+        """Return the signed-in user, resolved once per request.
+
+        A new service instance handles each request, so attributes on
+        self act as a request-scoped cache.
+        """
+        if not hasattr(self, '_user'):
+            self._user = endpoints.get_current_user()
+        return self._user
+
+    def _currentUserId(self):
+        """Return the signed-in user's ID, resolved once per request."""
+        if not hasattr(self, '_userId'):
+            self._userId = getUserId(self._currentUser())
+        return self._userId
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        # the Profile is loaded at most once per request
+        if getattr(self, '_profile', None) is not None:
+            return self._profile
+
         # make sure user is authed
-        user = endpoints.get_current_user()
+        user = self._currentUser()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
         # get Profile from datastore
-        user_id = getUserId(user)
+        user_id = self._currentUserId()
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -624,8 +1619,21 @@ class ConferenceApi(remote.Service):
             )
             profile.put()
 
+        self._profile = profile
         return profile      # return Profile
 
+    def _copyProfileToFormWithChildren(self, prof):
+        """Copy Profile to ProfileForm, listing its Registrations and
+        WishlistEntries."""
+        pf = self._copyProfileToForm(prof)
+        pf.conferenceKeysToAttend = [
+            c_key.urlsafe()
+            for c_key in self._getRegisteredConferenceKeys(prof.key)]
+        pf.sessionKeysWishlist = [
+            s_key.urlsafe()
+            for s_key in self._getWishlistSessionKeys(prof.key)]
+        return pf
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -633,6 +1641,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            old_name = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -643,9 +1652,65 @@ class ConferenceApi(remote.Service):
                         # else:
                         #    setattr(prof, field, val)
                         prof.put()
+            # push a changed name out to the conferences this user organizes
+            if prof.displayName != old_name:
+                taskqueue.add(params={'userId': prof.key.id()},
+                              url='/tasks/update_organizer_name'
+                              )
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        return self._copyProfileToFormWithChildren(prof)
+
+    @staticmethod
+    def _updateOrganizerDisplayName(user_id):
+        """Copy the Profile displayName onto every Conference it organizes.
+
+        Used by the organizer name task queue worker after saveProfile.
+        """
+        p_key = ndb.Key(Profile, user_id)
+        prof = p_key.get()
+        if not prof:
+            return
+        for c_key in Conference.query(ancestor=p_key).iter(keys_only=True):
+            if ConferenceApi._setOrganizerDisplayName(c_key,
+                                                      prof.displayName):
+                ConferenceApi._bumpConferenceCache(c_key.urlsafe())
+
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerDisplayName(c_key, name):
+        """Store name on one Conference; False if it was already current.
+
+        Runs in its own transaction so a concurrent updateConference is
+        not overwritten with a stale copy.
+        """
+        conf = c_key.get()
+        if not conf or conf.organizerDisplayName == name:
+            return False
+        conf.organizerDisplayName = name
+        conf.put()
+        return True
+
+    @staticmethod
+    def _backfillOrganizerDisplayNames(cursor=None):
+        """Enqueue organizer name updates for one batch of Profiles.
+
+        Populates organizerDisplayName on conferences created before it
+        was stored on the Conference entity. Chains a task for the next
+        batch until done.
+        """
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        p_keys, next_cursor, more = Profile.query().fetch_page(
+            ORGANIZER_NAME_BATCH_SIZE, start_cursor=start, keys_only=True)
+        tasks = [taskqueue.Task(params={'userId': p_key.id()},
+                                url='/tasks/update_organizer_name')
+                 for p_key in p_keys]
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_organizer_names'
+                          )
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
@@ -664,38 +1729,214 @@ class ConferenceApi(remote.Service):
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the cached announcement list from the datastore.
+
+        The list is a dict of websafe conference key to name and seats
+        left, kept up to date by _updateAnnouncement as registrations
+        change; the cron job runs this as a repair pass.
         """
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= ANNOUNCEMENT_MAX_SEATS,
             Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        ).fetch(projection=[Conference.name, Conference.seatsAvailable])
+
+        # an empty dict is cached too, so a missing entry means evicted
+        items = dict((conf.key.urlsafe(),
+                      {'name': conf.name,
+                       'seatsAvailable': conf.seatsAvailable})
+                     for conf in confs)
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, items)
+        return items
+
+    @staticmethod
+    def _updateAnnouncement(conf, seats):
+        """Add conf to, update or drop it from the cached announcement.
 
-        return announcement
+        Called with the new seat total whenever it changes; concurrent
+        updates are merged with memcache compare-and-set.
+        """
+        wsck = conf.key.urlsafe()
+        in_window = 0 < seats <= ANNOUNCEMENT_MAX_SEATS
+        client = memcache.Client()
+        for attempt in range(ANNOUNCEMENT_CAS_RETRIES):
+            items = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if items is None:
+                ConferenceApi._cacheAnnouncement()
+                continue
+            if in_window:
+                item = {'name': conf.name, 'seatsAvailable': seats}
+                if items.get(wsck) == item:
+                    return
+                items[wsck] = item
+            elif wsck in items:
+                del items[wsck]
+            else:
+                return
+            if client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, items):
+                return
+        logging.warning('Could not update announcement for %s', wsck)
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(message_types.VoidMessage, AnnouncementForm,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        items = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if items is None:
+            items = self._cacheAnnouncement()
+        forms = sorted((AnnouncementItemForm(websafeConferenceKey=wsck,
+                                             name=item['name'],
+                                             seatsAvailable=item[
+                                                 'seatsAvailable'])
+                        for wsck, item in items.iteritems()),
+                       key=lambda form: form.name)
+        data = ''
+        if forms:
+            data = ANNOUNCEMENT_TPL % ', '.join(form.name for form in forms)
+        return AnnouncementForm(data=data, items=forms)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _seatShardKeys(c_key):
+        """Return the keys of the seat shards for a conference."""
+        wsck = c_key.urlsafe()
+        return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+                for i in range(SEAT_SHARDS)]
+
+    @staticmethod
+    def _splitSeats(seats):
+        """Split a seat count into SEAT_SHARDS near-equal parts."""
+        base, extra = divmod(max(seats or 0, 0), SEAT_SHARDS)
+        return [base + (1 if i < extra else 0) for i in range(SEAT_SHARDS)]
+
+    @staticmethod
+    @ndb.transactional(propagation=ndb.TransactionOptions.ALLOWED)
+    def _seedSeatShard(key, c_key, seats):
+        """Return a seat shard, creating it with seats if it doesn't exist."""
+        shard = key.get()
+        if shard is None:
+            shard = SeatShard(key=key, conference=c_key, seatsAvailable=seats)
+            shard.put()
+        return shard
+
+    @staticmethod
+    def _getSeatShards(conf):
+        """Return the seat shards for conf.
+
+        Conferences created before seats were sharded get their shards
+        seeded from the seatsAvailable stored on the Conference.
+        """
+        keys = ConferenceApi._seatShardKeys(conf.key)
+        shards = ndb.get_multi(keys)
+        if None in shards:
+            seats = ConferenceApi._splitSeats(conf.seatsAvailable)
+            shards = [shard or ConferenceApi._seedSeatShard(
+                key, conf.key, seats[i])
+                for i, (key, shard) in enumerate(zip(keys, shards))]
+        return shards
+
+    @staticmethod
+    def _adjustSeats(conf, delta):
+        """Add delta seats across a conference's shards.
+
+        Negative deltas take seats from shards that still have them; a
+        shard never goes below zero. Returns the new total.
+        """
+        shards = ConferenceApi._getSeatShards(conf)
+        if delta > 0:
+            for shard, seats in zip(shards, ConferenceApi._splitSeats(delta)):
+                shard.seatsAvailable += seats
+        else:
+            remaining = -delta
+            for shard in shards:
+                taken = min(shard.seatsAvailable, remaining)
+                shard.seatsAvailable -= taken
+                remaining -= taken
+        ndb.put_multi(shards)
+        return sum(shard.seatsAvailable for shard in shards)
+
+    @staticmethod
+    def _syncSeatsAvailable(wsck):
+        """Copy the shard total onto Conference.seatsAvailable.
+
+        Keeps the indexed seatsAvailable used by list endpoints and the
+        announcement query in step with the shards, and corrects the
+        announcement, which registrations update from a total read
+        before their own change.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        shards = ndb.get_multi(ConferenceApi._seatShardKeys(c_key))
+        if None in shards:
+            return
+        seats = sum(shard.seatsAvailable for shard in shards)
+
+        @ndb.transactional()
+        def store():
+            conf = c_key.get()
+            if conf and conf.seatsAvailable != seats:
+                conf.seatsAvailable = seats
+                conf.put()
+                ConferenceApi._bumpConferenceCache(wsck)
+            return conf
+        conf = store()
+        if conf:
+            ConferenceApi._updateAnnouncement(conf, seats)
+
+    @staticmethod
+    def _enqueueSeatSync(wsck):
+        """Schedule a seatsAvailable sync, coalesced per SEAT_SYNC_DELAY."""
+        window = int(time.time()) // SEAT_SYNC_DELAY
+        try:
+            taskqueue.add(params={'wsck': wsck},
+                          url='/tasks/sync_seats',
+                          name='sync-seats-%s-%d' % (wsck, window),
+                          countdown=SEAT_SYNC_DELAY
+                          )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _registrationKey(p_key, wsck):
+        """Return the Registration key for a Profile and conference."""
+        return ndb.Key(Registration, wsck, parent=p_key)
+
     @ndb.transactional(xg=True)
+    def _reserveSeat(self, p_key, shard_key, wsck):
+        """Take a seat from one shard for the user.
+
+        Returns False if the shard is empty, and None if users are
+        waiting, as freed seats are then held for the promotion worker.
+        """
+        r_key = self._registrationKey(p_key, wsck)
+        reg, shard, waitlist = ndb.get_multi(
+            [r_key, shard_key, self._waitlistCounterKey(wsck)])
+        if reg:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if waitlist and waitlist.waiting > 0:
+            return None
+        if shard.seatsAvailable <= 0:
+            return False
+        shard.seatsAvailable -= 1
+        ndb.put_multi([Registration(key=r_key,
+                                    conference=ndb.Key(urlsafe=wsck)),
+                       shard])
+        return True
+
+    @ndb.transactional(xg=True)
+    def _releaseSeat(self, p_key, shard_key, wsck):
+        """Return the user's seat to a shard; False if not registered."""
+        r_key = self._registrationKey(p_key, wsck)
+        reg, shard = ndb.get_multi([r_key, shard_key])
+        if not reg:
+            return False
+        shard.seatsAvailable += 1
+        r_key.delete()
+        shard.put()
+        return True
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
@@ -712,36 +1953,229 @@ class ConferenceApi(remote.Service):
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            reg_, waitlist = ndb.get_multi([
+                self._registrationKey(prof.key, wsck),
+                self._waitlistCounterKey(wsck)])
+            if reg_:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            # while users are waiting, freed seats are held for the
+            # promotion worker so the waitlist is served in order
+            queued = waitlist is not None and waitlist.waiting > 0
+
+            # try shards with seats left in random order so concurrent
+            # registrations land on different entity groups; re-read the
+            # shards once before reporting sold out
+            retval = False
+            for attempt in range(0 if queued else 2):
+                shards = self._getSeatShards(conf)
+                open_keys = [shard.key for shard in shards
+                             if shard.seatsAvailable > 0]
+                random.shuffle(open_keys)
+                for shard_key in open_keys:
+                    reserved = self._reserveSeat(prof.key, shard_key, wsck)
+                    if reserved is None:
+                        queued = True
+                        break
+                    if reserved:
+                        retval = True
+                        seats = sum(shard.seatsAvailable
+                                    for shard in shards) - 1
+                        break
+                if retval or queued or not open_keys:
+                    break
+
+            # sold out: queue the user for a seat instead of failing, so
+            # clients wait for a promotion rather than retrying
+            if not retval:
+                position, created = self._joinWaitlist(prof.key, conf.key)
+                if created:
+                    # seats may be held for the queue, or have been lost
+                    # to races above; make sure the worker looks
+                    self._enqueueWaitlistPromotion(wsck)
+                return RegistrationResultForm(data=False,
+                                              waitlistPosition=position)
 
         # unregister
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
+            shards = self._getSeatShards(conf)
+            shard = random.choice(shards)
+            retval = self._releaseSeat(prof.key, shard.key, wsck)
+            seats = sum(shard.seatsAvailable for shard in shards) + 1
+            if retval:
+                self._enqueueWaitlistPromotion(wsck)
             else:
-                retval = False
+                # not registered; drop the user from the waitlist instead
+                return RegistrationResultForm(
+                    data=self._leaveWaitlist(prof.key, wsck))
+
+        if retval:
+            self._bumpConferenceCache(wsck)
+            self._enqueueSeatSync(wsck)
+            # seats is the total as read just before the change; any
+            # drift from concurrent registrations is fixed by the cron
+            self._updateAnnouncement(conf, seats)
+        return RegistrationResultForm(data=retval)
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+    @staticmethod
+    def _waitlistKey(p_key, wsck):
+        """Return the WaitlistEntry key for a Profile and conference."""
+        return ndb.Key(WaitlistEntry, wsck, parent=p_key)
+
+    @staticmethod
+    def _waitlistCounterKey(wsck):
+        """Return the key of a conference's Waitlist counters."""
+        return ndb.Key(Waitlist, wsck)
+
+    def _joinWaitlist(self, p_key, c_key):
+        """Add the user to a conference's waitlist, once.
+
+        Returns (position, created). The position is the user's ticket
+        less the entries already served, so it can overstate the queue
+        ahead of them by users who left it.
+        """
+        wsck = c_key.urlsafe()
+        # repeat requests are answered from two gets, without a
+        # transaction
+        entry, waitlist = ndb.get_multi([self._waitlistKey(p_key, wsck),
+                                         self._waitlistCounterKey(wsck)])
+        created = False
+        if entry is None or waitlist is None:
+            entry, waitlist, created = self._addWaitlistEntry(p_key, c_key)
+        return max(entry.position - waitlist.served, 1), created
+
+    @ndb.transactional(xg=True)
+    def _addWaitlistEntry(self, p_key, c_key):
+        """Return the user's WaitlistEntry and the Waitlist, creating the
+        entry with the next ticket if needed, and whether it was created."""
+        wsck = c_key.urlsafe()
+        w_key = self._waitlistKey(p_key, wsck)
+        wl_key = self._waitlistCounterKey(wsck)
+        reg, entry, waitlist = ndb.get_multi([
+            self._registrationKey(p_key, wsck), w_key, wl_key])
+        if reg:
+            raise ConflictException(
+                "You have already registered for this conference")
+        waitlist = waitlist or Waitlist(key=wl_key)
+        if entry is not None:
+            return entry, waitlist, False
+        entry = WaitlistEntry(key=w_key, conference=c_key,
+                              position=waitlist.nextPosition)
+        waitlist.nextPosition += 1
+        waitlist.waiting += 1
+        ndb.put_multi([entry, waitlist])
+        return entry, waitlist, True
+
+    @ndb.transactional(xg=True)
+    def _leaveWaitlist(self, p_key, wsck):
+        """Remove the user from a waitlist; False if they were not on it."""
+        w_key = self._waitlistKey(p_key, wsck)
+        entry, waitlist = ndb.get_multi([w_key,
+                                         self._waitlistCounterKey(wsck)])
+        if entry is None:
+            return False
+        w_key.delete()
+        if waitlist:
+            waitlist.waiting = max(waitlist.waiting - 1, 0)
+            waitlist.put()
+        return True
+
+    @staticmethod
+    def _enqueueWaitlistPromotion(wsck):
+        """Schedule waitlist promotion, coalesced per SEAT_SYNC_DELAY."""
+        window = int(time.time()) // SEAT_SYNC_DELAY
+        try:
+            taskqueue.add(params={'wsck': wsck},
+                          url='/tasks/promote_waitlist',
+                          name='promote-waitlist-%s-%d' % (wsck, window),
+                          countdown=SEAT_SYNC_DELAY
+                          )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Register waitlisted users for freed seats, longest waiting first.
+
+        Runs up to WAITLIST_BATCHES_PER_TASK transactions of
+        WAITLIST_PROMOTE_BATCH users, then chains another task if seats
+        and waiting users both remain.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        if not conf:
+            return
+        # make sure legacy conferences have their shards seeded
+        seats = sum(shard.seatsAvailable
+                    for shard in ConferenceApi._getSeatShards(conf))
+        promoted = 0
+        for batch in range(WAITLIST_BATCHES_PER_TASK):
+            if seats <= 0:
+                break
+            w_keys = WaitlistEntry.query(
+                WaitlistEntry.conference == c_key).order(
+                WaitlistEntry.position).fetch(WAITLIST_PROMOTE_BATCH,
+                                              keys_only=True)
+            if not w_keys:
+                break
+            count, seats = ConferenceApi._promoteWaitlistBatch(c_key, w_keys)
+            promoted += count
+        else:
+            ConferenceApi._enqueueWaitlistPromotion(wsck)
+
+        if promoted:
+            ConferenceApi._bumpConferenceCache(wsck)
+            ConferenceApi._enqueueSeatSync(wsck)
+            ConferenceApi._updateAnnouncement(conf, seats)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _promoteWaitlistBatch(c_key, w_keys):
+        """Move waitlisted users into free seats in one transaction.
+
+        Entries already gone or already registered are skipped. Returns
+        (users promoted, seats left).
+        """
+        wsck = c_key.urlsafe()
+        shards = [shard for shard in
+                  ndb.get_multi(ConferenceApi._seatShardKeys(c_key))
+                  if shard]
+        waitlist = ConferenceApi._waitlistCounterKey(wsck).get()
+        entries = ndb.get_multi(w_keys)
+        regs = ndb.get_multi([ConferenceApi._registrationKey(
+            w_key.parent(), wsck) for w_key in w_keys])
+
+        open_shards = [shard for shard in shards if shard.seatsAvailable > 0]
+        puts = []
+        deletes = []
+        for w_key, entry, reg in zip(w_keys, entries, regs):
+            if entry is None:
+                continue
+            if reg is not None:
+                deletes.append(w_key)
+                continue
+            if not open_shards:
+                break
+            shard = open_shards[0]
+            shard.seatsAvailable -= 1
+            if shard.seatsAvailable <= 0:
+                open_shards.pop(0)
+            puts.append(Registration(
+                key=ConferenceApi._registrationKey(w_key.parent(), wsck),
+                conference=c_key))
+            deletes.append(w_key)
+        promoted = len(puts)
+        if puts:
+            puts += shards
+        if waitlist and deletes:
+            waitlist.served += len(deletes)
+            waitlist.waiting = max(waitlist.waiting - len(deletes), 0)
+            puts.append(waitlist)
+        ndb.put_multi(puts)
+        ndb.delete_multi(deletes)
+        return promoted, sum(shard.seatsAvailable for shard in shards)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
@@ -749,37 +2183,68 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        conf_keys = self._getRegisteredConferenceKeys(prof.key)
+        conferences = [conf for conf in ndb.get_multi(conf_keys) if conf]
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
+        return ConferenceForms(items=[self._copyConferenceToForm(conf)
                                       for conf in conferences]
                                )
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @staticmethod
+    def _getRegisteredConferenceKeys(p_key):
+        """Return the keys of conferences a Profile is registered for."""
+        return [ndb.Key(urlsafe=r_key.id()) for r_key in
+                Registration.query(ancestor=p_key).fetch(keys_only=True)]
+
+    @staticmethod
+    def _migrateProfiles(cursor=None):
+        """Move legacy repeated fields off one batch of Profile entities.
+
+        Each registration in conferenceKeysToAttend becomes a Registration
+        child entity and each sessionKeysWishlist entry a WishlistEntry.
+        Chains a task for the next batch until done.
+        """
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=start)
+        for prof in profiles:
+            if prof.conferenceKeysToAttend or prof.sessionKeysWishlist:
+                ConferenceApi._migrateProfile(prof.key)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/migrate_profiles'
+                          )
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfile(p_key):
+        """Move one Profile's legacy repeated fields into child entities."""
+        prof = p_key.get()
+        regs = [Registration(key=ConferenceApi._registrationKey(p_key, wsck),
+                             conference=ndb.Key(urlsafe=wsck))
+                for wsck in prof.conferenceKeysToAttend]
+        wishes = [WishlistEntry(key=ConferenceApi._wishlistKey(p_key, wssk),
+                                session=ndb.Key(urlsafe=wssk))
+                  for wssk in prof.sessionKeysWishlist]
+        prof.conferenceKeysToAttend = []
+        prof.sessionKeysWishlist = []
+        ndb.put_multi(regs + wishes + [prof])
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationResultForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
     def registerForConference(self, request):
-        """Register user for selected conference."""
+        """Register user for selected conference, or join its waitlist
+        if it is sold out."""
         return self._conferenceRegistration(request)
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_GET_REQUEST, RegistrationResultForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
-        """Unregister user for selected conference."""
+        """Unregister user for selected conference, or take them off its
+        waitlist."""
         return self._conferenceRegistration(request, reg=False)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -798,8 +2263,9 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.month == 6)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf) for conf in q]
         )
 
 
-api = endpoints.api_server([ConferenceApi])  # register API
+api = instrumentation.InstrumentationMiddleware(
+    endpoints.api_server([ConferenceApi]))  # register API
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+instrumentation.py -- count datastore, memcache and other API RPCs
+
+An apiproxy pre-call hook counts every RPC made by the current request,
+and with a post-call hook also the serial round trips: RPCs started while
+none of the thread's other RPCs were in flight.
+InstrumentationMiddleware wraps a WSGI app, so each Endpoints method and
+main.py handler gets its RPC counts, wall time and response size added
+to running totals in memcache, read back by rpcStats(). Code can also
+be measured directly with counting(), e.g. to assert an RPC budget:
+
+    with instrumentation.counting() as counts:
+        api.getConference(request)
+    assert counts['datastore.get'] <= 1
+    assert counts.roundTrips <= 2
+
+"""
+
+import contextlib
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+MEMCACHE_RPC_STATS_KEY = "RPC_STATS:"
+RPC_CATEGORIES = {
+    ('datastore_v3', 'Get'): 'datastore.get',
+    ('datastore_v3', 'Put'): 'datastore.put',
+    ('datastore_v3', 'Delete'): 'datastore.delete',
+    ('datastore_v3', 'RunQuery'): 'datastore.query',
+    ('datastore_v3', 'Next'): 'datastore.next',
+    ('datastore_v3', 'AllocateIds'): 'datastore.allocate_ids',
+    ('datastore_v3', 'BeginTransaction'): 'datastore.transaction',
+    ('datastore_v3', 'Commit'): 'datastore.commit',
+    ('memcache', 'Get'): 'memcache.get',
+    ('memcache', 'Set'): 'memcache.set',
+}
+SERVICE_CATEGORIES = {
+    'datastore_v3': 'datastore.other',
+    'memcache': 'memcache.other',
+    'taskqueue': 'taskqueue',
+    'urlfetch': 'urlfetch',
+    'mail': 'mail',
+}
+CATEGORIES = sorted(set(RPC_CATEGORIES.values()) |
+                    set(SERVICE_CATEGORIES.values()) | set(['other']))
+
+_local = threading.local()
+
+
+class RpcCounts(dict):
+    """RPC counts by category; roundTrips counts the RPCs that started
+    with no other RPC of the thread in flight, i.e. the serial waits."""
+
+    def __init__(self):
+        super(RpcCounts, self).__init__()
+        self.roundTrips = 0
+
+
+def _countRpc(service, call, request, response):
+    """apiproxy pre-call hook adding the RPC to the active counters."""
+    inflight = getattr(_local, 'inflight', 0)
+    _local.inflight = inflight + 1
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        return
+    category = RPC_CATEGORIES.get((service, call)) or \
+        SERVICE_CATEGORIES.get(service, 'other')
+    for counts in counters:
+        counts[category] = counts.get(category, 0) + 1
+        if not inflight:
+            counts.roundTrips += 1
+
+
+def _rpcDone(service, call, request, response, rpc, error):
+    """apiproxy post-call hook marking one of the thread's RPCs done."""
+    _local.inflight = max(getattr(_local, 'inflight', 0) - 1, 0)
+
+
+def installHook():
+    """Add the counting hooks to the current apiproxy, once.
+
+    The apiproxy is replaced when a testbed is activated, so this runs
+    on every counting() block rather than only at import.
+    """
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'instrumentation', _countRpc)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'instrumentation', _rpcDone)
+
+
+@contextlib.contextmanager
+def counting():
+    """Count the RPCs made by this thread inside the block.
+
+    Yields an RpcCounts dict of category to count, filled in as RPCs are
+    made. Blocks may be nested; each sees every RPC made inside it.
+    """
+    installHook()
+    counts = RpcCounts()
+    counters = getattr(_local, 'counters', None)
+    if not counters:
+        _local.inflight = 0
+    _local.counters = (counters or []) + [counts]
+    try:
+        yield counts
+    finally:
+        _local.counters = counters
+
+
+def _record(name, counts, millis, size):
+    """Add one request's measurements to the totals in memcache."""
+    deltas = {'%s|calls' % name: 1,
+              '%s|ms' % name: int(millis),
+              '%s|bytes' % name: size}
+    for category, count in counts.iteritems():
+        deltas['%s|%s' % (name, category)] = count
+    memcache.offset_multi(deltas, key_prefix=MEMCACHE_RPC_STATS_KEY,
+                          initial_value=0)
+
+
+def rpcStats(names):
+    """Return per-request averages for the named requests seen so far.
+
+    Returns a dict of name to calls, avgMs, avgBytes and an rpcs dict of
+    average RPCs per category; names never called are left out.
+    """
+    keys = ['%s|%s' % (name, stat) for name in names
+            for stat in ['calls', 'ms', 'bytes'] + CATEGORIES]
+    totals = memcache.get_multi(keys, key_prefix=MEMCACHE_RPC_STATS_KEY)
+    stats = {}
+    for name in names:
+        calls = totals.get('%s|calls' % name)
+        if not calls:
+            continue
+        rpcs = {}
+        for category in CATEGORIES:
+            count = totals.get('%s|%s' % (name, category))
+            if count:
+                rpcs[category] = round(float(count) / calls, 2)
+        stats[name] = {
+            'calls': calls,
+            'avgMs': round(float(totals.get('%s|ms' % name, 0)) / calls, 1),
+            'avgBytes': totals.get('%s|bytes' % name, 0) // calls,
+            'rpcs': rpcs,
+        }
+    return stats
+
+
+def resetRpcStats(names):
+    """Clear the totals for the named requests."""
+    memcache.delete_multi(['%s|%s' % (name, stat) for name in names
+                           for stat in ['calls', 'ms', 'bytes'] + CATEGORIES],
+                          key_prefix=MEMCACHE_RPC_STATS_KEY)
+
+
+class InstrumentationMiddleware(object):
+    """WSGI middleware recording RPCs, wall time and response size per
+    request path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        name = environ.get('PATH_INFO', '')
+        start = time.time()
+        with counting() as counts:
+            result = self.app(environ, start_response)
+            try:
+                # read the body here so RPCs made while it is produced
+                # are counted and its size is known
+                body = list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        millis = (time.time() - start) * 1000
+        try:
+            _record(name, counts, millis, sum(len(chunk) for chunk in body))
+        except Exception:
+            # stats are best effort and must never fail the request
+            pass
+        return body
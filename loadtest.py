@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+
+"""
+loadtest.py -- load test ConferenceApi against the App Engine local stubs
+
+Seeds the testbed datastore with conferences, sessions and profiles, then
+calls the ConferenceApi endpoints directly from several threads and
+reports p50/p99 latency and RPCs per call for each endpoint, and the peak
+memory of the whole run.
+
+    python loadtest.py --sdk ~/google_appengine
+    python loadtest.py --sdk ~/google_appengine --conferences 50000 \\
+        --sessions 500000 --profiles 100000 --save-baseline base.json
+    python loadtest.py --sdk ~/google_appengine --baseline base.json
+
+Every run exits non-zero if any endpoint's RPCs per call grew past the
+tolerance over rpc_baseline.json, which is committed; refresh it with
+--save-rpc-baseline when a change legitimately adds RPCs, using the data
+volume recorded in it:
+
+    python loadtest.py --sdk ~/google_appengine --conferences 1000 \\
+        --sessions 5000 --profiles 1000 --save-rpc-baseline
+
+The stubs are in process, so latencies are only comparable between runs
+on the same machine. p99 latency is therefore only checked against a
+local --baseline file saved with --save-baseline.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RPC_BASELINE = os.path.join(ROOT, 'rpc_baseline.json')
+
+CITIES = ['London', 'Chicago', 'Paris', 'Tokyo', 'San Francisco', 'Berlin']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['NOT_SPECIFIED', 'KEYNOTE', 'LECTURE', 'WORKSHOP',
+                 'FREEFORM']
+SEED_BATCH_SIZE = 500
+# the options an RPC baseline records
+RUN_SETTINGS = ('conferences', 'sessions', 'profiles', 'requests',
+                'threads', 'seed')
+
+
+def fixSysPath(sdk):
+    """Put the SDK, its bundled libraries and this app on sys.path, once."""
+    if sdk in sys.path:
+        return
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def setUpTestbed(sdk):
+    """Put the SDK on sys.path and activate a testbed with every stub the
+    API uses."""
+    fixSysPath(sdk)
+
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # Endpoints reads the deployment from '<version>.<deployment>'
+    bed.setup_env(current_version_id='testbed.1', overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_urlfetch_stub()
+    bed.init_mail_stub()
+    bed.init_blobstore_stub()
+    bed.init_app_identity_stub()
+    bed.init_user_stub()
+    return bed
+
+
+def seed(conferences, sessions, profiles, rng):
+    """Write the seed data; returns the keys the scenarios pick from."""
+    from google.appengine.ext import ndb
+    from conference import ConferenceApi
+    from models import Conference, Profile, Session, Speaker
+
+    def putInBatches(entities):
+        for i in range(0, len(entities), SEED_BATCH_SIZE):
+            ndb.put_multi(entities[i:i + SEED_BATCH_SIZE])
+
+    emails = ['user%d@example.com' % i for i in range(profiles)]
+    putInBatches([Profile(key=ndb.Key(Profile, email),
+                          displayName='User %d' % i, mainEmail=email,
+                          teeShirtSize='NOT_SPECIFIED')
+                  for i, email in enumerate(emails)])
+
+    conf_keys = []
+    for start in range(0, conferences, SEED_BATCH_SIZE):
+        entities = []
+        for i in range(start, min(start + SEED_BATCH_SIZE, conferences)):
+            organizer = rng.choice(emails)
+            seats = rng.choice([0, 5, 50, 200, 1000])
+            conf = Conference(
+                key=ndb.Key(Profile, organizer, Conference, i + 1),
+                name='Conference %d %s' % (i, rng.choice(TOPICS)),
+                description='A conference about %s' % rng.choice(TOPICS),
+                organizerUserId=organizer,
+                organizerDisplayName=organizer,
+                topics=rng.sample(TOPICS, 2),
+                city=rng.choice(CITIES),
+                month=rng.randint(1, 12),
+                maxAttendees=seats, seatsAvailable=seats)
+            entities.append(conf)
+            entities.extend(ConferenceApi._newConferenceEntities(conf))
+            conf_keys.append(conf.key)
+        ndb.put_multi(entities)
+
+    speakers = ['Speaker %d' % i for i in range(max(sessions // 20, 1))]
+    session_keys = []
+    speaker_sessions = {}
+    for start in range(0, sessions, SEED_BATCH_SIZE):
+        entities = []
+        for i in range(start, min(start + SEED_BATCH_SIZE, sessions)):
+            speaker = rng.choice(speakers)
+            sesh = Session(
+                key=ndb.Key(Session, i + 1, parent=rng.choice(conf_keys)),
+                name='Session %d' % i, speaker=speaker,
+                speakerKey=ConferenceApi._speakerKey(speaker),
+                highlights='All about %s' % rng.choice(TOPICS),
+                durationInMin=rng.choice([30, 45, 60, 90]),
+                typeOfSession=rng.choice(SESSION_TYPES),
+                startTime=datetime.time(rng.randint(8, 21),
+                                        rng.choice([0, 30])))
+            entities.append(sesh)
+            entities.append(ConferenceApi._sessionSearchDocument(sesh))
+            session_keys.append(sesh.key)
+            speaker_sessions.setdefault(sesh.speakerKey, (speaker, []))[
+                1].append(sesh.key)
+        ndb.put_multi(entities)
+    putInBatches([Speaker(key=sp_key, name=ConferenceApi._speakerName(name),
+                          sessionKeys=s_keys)
+                  for sp_key, (name, s_keys) in speaker_sessions.items()])
+
+    return {'emails': emails, 'conferences': conf_keys,
+            'sessions': session_keys, 'speakers': speakers, 'created': []}
+
+
+def scenarios():
+    """Return (name, call) pairs; call(api, data, rng) makes one request.
+
+    Scenarios run in order, and each worker thread makes the same random
+    choices in every scenario, so removeSessionFromWishlist removes the
+    entries addSessionToWishlist added. deleteSession deletes the sessions
+    createSession added, leaving the seeded ones for the other scenarios.
+    """
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    from protorpc import message_types
+    import conference as c
+    from models import (ConferenceForm, ConferenceQueryForm,
+                        ConferenceQueryForms, ProfileMiniForm, SessionForm,
+                        SessionKeyForm, SessionQueryForm, SessionQueryForms,
+                        SessionTypeForm, SpeakerMessage, TeeShirtSize)
+
+    def conf(data, rng):
+        return c.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=rng.choice(data['conferences']).urlsafe())
+
+    def sesh(data, rng):
+        return SessionKeyForm(
+            websafeSessionKey=rng.choice(data['sessions']).urlsafe())
+
+    def organize(api, key):
+        # sign in as the organizer of the conference, or of its session
+        while key.kind() != 'Conference':
+            key = key.parent()
+        api._user = users.User(key.parent().id())
+
+    def organizedConf(api, data, rng):
+        c_key = rng.choice(data['conferences'])
+        organize(api, c_key)
+        return c_key.urlsafe()
+
+    def sessionFields(data, rng):
+        return {
+            'name': 'Session %d' % rng.randint(0, 10 ** 6),
+            'speaker': rng.choice(data['speakers']),
+            'highlights': 'All about %s' % rng.choice(TOPICS),
+            'durationInMin': rng.choice([30, 45, 60, 90]),
+            'typeOfSession': rng.choice(SESSION_TYPES),
+            'startTime': '%02d:%02d' % (rng.randint(8, 21),
+                                        rng.choice([0, 30])),
+        }
+
+    def createConference(api, data, rng):
+        api.createConference(ConferenceForm(
+            name='Conference %s' % rng.choice(TOPICS),
+            description='A conference about %s' % rng.choice(TOPICS),
+            topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+            maxAttendees=rng.choice([0, 5, 50, 200, 1000])))
+
+    def updateConference(api, data, rng):
+        api.updateConference(c.CONF_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=organizedConf(api, data, rng),
+            description='A conference about %s' % rng.choice(TOPICS)))
+
+    def createSession(api, data, rng):
+        form = api.createSession(c.SESH_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=organizedConf(api, data, rng),
+            **sessionFields(data, rng)))
+        data['created'].append(form.websafeKey)
+
+    def createSessions(api, data, rng):
+        api.createSessions(c.SESHS_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=organizedConf(api, data, rng),
+            items=[SessionForm(**sessionFields(data, rng))
+                   for _ in range(5)]))
+
+    def deleteSession(api, data, rng):
+        # list.pop is atomic, so threads never delete the same session
+        wssk = data['created'].pop()
+        organize(api, ndb.Key(urlsafe=wssk))
+        api.deleteSession(SessionKeyForm(websafeSessionKey=wssk))
+
+    def registrationRoundTrip(api, data, rng):
+        # unregistering also takes a waitlisted user off the waitlist
+        request = conf(data, rng)
+        api.registerForConference(request)
+        api.unregisterFromConference(request)
+
+    return [
+        ('queryConferences', lambda api, data, rng: api.queryConferences(
+            ConferenceQueryForms(filters=[ConferenceQueryForm(
+                field='CITY', operator='EQ', value=rng.choice(CITIES))]))),
+        ('getConference', lambda api, data, rng: api.getConference(
+            conf(data, rng))),
+        ('getConferencesByTopic', lambda api, data, rng:
+            api.getConferencesByTopic(c.TOPIC_REQUEST.combined_message_class(
+                topic=rng.choice(TOPICS)))),
+        ('getConferencesCreated', lambda api, data, rng:
+            api.getConferencesCreated(
+                c.SELECT_REQUEST.combined_message_class())),
+        ('createConference', createConference),
+        ('updateConference', updateConference),
+        ('getConferenceSessions',
+         lambda api, data, rng: api.getConferenceSessions(
+             c.SESH_REQUEST.combined_message_class(
+                 websafeConferenceKey=rng.choice(
+                     data['conferences']).urlsafe()))),
+        ('getConferenceSessionsByType',
+         lambda api, data, rng: api.getConferenceSessionsByType(
+             c.SESH_BY_TYPE_REQUEST.combined_message_class(
+                 websafeConferenceKey=rng.choice(
+                     data['conferences']).urlsafe(),
+                 stype=rng.choice(SESSION_TYPES)))),
+        ('getSessionsByType', lambda api, data, rng: api.getSessionsByType(
+            SessionTypeForm(sessionType=rng.choice(SESSION_TYPES)))),
+        ('getSessionsBySpeaker', lambda api, data, rng:
+            api.getSessionsBySpeaker(
+                SpeakerMessage(speaker=rng.choice(data['speakers'])))),
+        ('getEarlyNonWorkshopSessions', lambda api, data, rng:
+            api.getEarlyNonWorkshopSessions(
+                c.EARLY_SESH_REQUEST.combined_message_class())),
+        ('querySessions', lambda api, data, rng: api.querySessions(
+            SessionQueryForms(filters=[
+                SessionQueryForm(field='TYPE', operator='EQ',
+                                 value=rng.choice(SESSION_TYPES)),
+                SessionQueryForm(field='START_TIME', operator='LT',
+                                 value='12:00')]))),
+        ('createSession', createSession),
+        ('createSessions', createSessions),
+        ('deleteSession', deleteSession),
+        ('searchConferences', lambda api, data, rng: api.searchConferences(
+            c.SEARCH_REQUEST.combined_message_class(
+                q=rng.choice(TOPICS).split()[0][:4]))),
+        ('searchSessions', lambda api, data, rng: api.searchSessions(
+            c.SESH_SEARCH_REQUEST.combined_message_class(
+                q=rng.choice(TOPICS).split()[0][:4]))),
+        ('getFeaturedSpeaker', lambda api, data, rng:
+            api.getFeaturedSpeaker(conf(data, rng))),
+        ('getAnnouncement', lambda api, data, rng: api.getAnnouncement(
+            message_types.VoidMessage())),
+        ('getProfile', lambda api, data, rng: api.getProfile(
+            message_types.VoidMessage())),
+        ('saveProfile', lambda api, data, rng: api.saveProfile(
+            ProfileMiniForm(
+                displayName='User %d' % rng.randint(0, 10 ** 6),
+                teeShirtSize=rng.choice(list(TeeShirtSize))))),
+        ('getConferencesToAttend', lambda api, data, rng:
+            api.getConferencesToAttend(message_types.VoidMessage())),
+        ('registerForConference', registrationRoundTrip),
+        ('addSessionToWishlist', lambda api, data, rng:
+            api.addSessionToWishlist(sesh(data, rng))),
+        ('getSessionsFromWishlist', lambda api, data, rng:
+            api.getSessionsFromWishlist(message_types.VoidMessage())),
+        ('removeSessionFromWishlist', lambda api, data, rng:
+            api.removeSessionFromWishlist(sesh(data, rng))),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(data, requests, threads, seed_value):
+    """Call every scenario requests times spread over threads; returns
+    {name: {p50Ms, p99Ms, rpcsPerCall, errors}}."""
+    import endpoints
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    import instrumentation
+    from conference import ConferenceApi
+
+    results = {}
+    for name, call in scenarios():
+        latencies = []
+        rpcs = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def worker(thread_index):
+            rng = random.Random(seed_value + thread_index)
+            for i in range(thread_index, requests, threads):
+                # a fresh service instance per call, as Endpoints does,
+                # signed in as a random seeded user
+                api = ConferenceApi()
+                api._user = users.User(rng.choice(data['emails']))
+                ndb.get_context().clear_cache()
+                start = time.time()
+                with instrumentation.counting() as counts:
+                    try:
+                        call(api, data, rng)
+                        failed = False
+                    except endpoints.ServiceException:
+                        failed = True
+                elapsed = (time.time() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    rpcs.append(sum(counts.values()))
+                    errors[0] += failed
+
+        workers = [threading.Thread(target=worker, args=(i,))
+                   for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        results[name] = {
+            'p50Ms': round(percentile(latencies, 0.5), 2),
+            'p99Ms': round(percentile(latencies, 0.99), 2),
+            'rpcsPerCall': round(float(sum(rpcs)) / len(rpcs), 2),
+            'errors': errors[0],
+        }
+    return results
+
+
+def compareLatency(results, baseline, tolerance):
+    """Return a list of p99 latency regressions of results against a
+    baseline of earlier results."""
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        result = results.get(name)
+        if result and result['p99Ms'] > base['p99Ms'] * (1 + tolerance):
+            regressions.append('%s: p99 %.2fms, baseline %.2fms'
+                               % (name, result['p99Ms'], base['p99Ms']))
+    return regressions
+
+
+def compareRpcs(results, baseline, tolerance):
+    """Return a list of RPC count regressions of results against a
+    baseline of {name: rpcsPerCall}."""
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        result = results.get(name)
+        if result and result['rpcsPerCall'] > base * (1 + tolerance):
+            regressions.append('%s: %.2f RPCs per call, baseline %.2f'
+                               % (name, result['rpcsPerCall'], base))
+    return regressions
+
+
+def maxRssMb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--conferences', type=int, default=5000)
+    parser.add_argument('--sessions', type=int, default=50000)
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='calls per endpoint')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='fail on p99 latency '
+                        'regressions against this results file')
+    parser.add_argument('--save-baseline', help='write results here')
+    parser.add_argument('--save-rpc-baseline', action='store_true',
+                        help='update the committed RPC baseline')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5)
+    parser.add_argument('--rpc-tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    bed = setUpTestbed(args.sdk)
+    try:
+        start = time.time()
+        data = seed(args.conferences, args.sessions, args.profiles,
+                    random.Random(args.seed))
+        print('Seeded %d conferences, %d sessions, %d profiles in %.1fs; '
+              'max RSS %.0fMB' % (args.conferences, args.sessions,
+                                  args.profiles, time.time() - start,
+                                  maxRssMb()))
+        results = run(data, args.requests, args.threads, args.seed)
+    finally:
+        bed.deactivate()
+
+    print('%-30s %10s %10s %10s %7s' % ('endpoint', 'p50 ms', 'p99 ms',
+                                        'RPCs/call', 'errors'))
+    for name, result in sorted(results.items()):
+        print('%-30s %10.2f %10.2f %10.2f %7d' % (
+            name, result['p50Ms'], result['p99Ms'], result['rpcsPerCall'],
+            result['errors']))
+    print('max RSS %.0fMB' % maxRssMb())
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    settings = dict((name, getattr(args, name)) for name in RUN_SETTINGS)
+    if args.save_rpc_baseline:
+        with open(RPC_BASELINE, 'w') as f:
+            json.dump({'settings': settings,
+                       'rpcsPerCall': dict(
+                           (name, result['rpcsPerCall'])
+                           for name, result in results.items())},
+                      f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+
+    with open(RPC_BASELINE) as f:
+        rpc_baseline = json.load(f)
+    if rpc_baseline['settings'] != settings:
+        # RPCs per call barely depend on data volume, so still compare
+        print('Note: the RPC baseline was recorded with %s' % ', '.join(
+            '--%s %s' % item for item in sorted(
+                rpc_baseline['settings'].items())))
+    regressions = compareRpcs(results, rpc_baseline['rpcsPerCall'],
+                              args.rpc_tolerance)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions += compareLatency(results, json.load(f),
+                                          args.latency_tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
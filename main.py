@@ -12,10 +12,16 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi, MEMCACHE_FT_SPEAKER_KEY
+from google.appengine.ext import blobstore
+from google.appengine.ext.webapp import blobstore_handlers
+import bulk
+import instrumentation
+from conference import ConferenceApi
 from google.appengine.api import memcache
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -24,16 +30,21 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
-class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
-    def post(self):
-        """Set Featured Speaker in Memcache"""
-        ConferenceApi._cacheFeaturedSpeaker(self.request.get('wsck'), self.request.get('speaker'))
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send queued Conference confirmation emails in batches."""
+        ConferenceApi._sendConfirmationEmails()
         self.response.set_status(204)
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation.
+
+        Only drains tasks queued before confirmations moved to the
+        confirmation-email pull queue.
+        """
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -44,9 +55,160 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's displayName onto their Conferences."""
+        ConferenceApi._updateOrganizerDisplayName(self.request.get('userId'))
+        self.response.set_status(204)
+
+
+class BackfillOrganizerNamesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start enqueueing organizer name updates for all Profiles."""
+        ConferenceApi._backfillOrganizerDisplayNames()
+        self.response.set_status(204)
+
+    def post(self):
+        """Enqueue updates for the next batch of Profiles from the cursor."""
+        ConferenceApi._backfillOrganizerDisplayNames(
+            self.request.get('cursor'))
+        self.response.set_status(204)
+
+class SyncSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a Conference's sharded seat total onto the Conference."""
+        ConferenceApi._syncSeatsAvailable(self.request.get('wsck'))
+        self.response.set_status(204)
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register waitlisted users for a Conference's freed seats."""
+        ConferenceApi._promoteWaitlist(self.request.get('wsck'))
+        self.response.set_status(204)
+
+class MigrateProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start migrating legacy Profile fields into child entities."""
+        ConferenceApi._migrateProfiles()
+        self.response.set_status(204)
+
+    def post(self):
+        """Migrate the next batch of Profiles from the given cursor."""
+        ConferenceApi._migrateProfiles(self.request.get('cursor'))
+        self.response.set_status(204)
+
+class MigrateSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start linking Sessions to Speaker entities."""
+        ConferenceApi._migrateSpeakers()
+        self.response.set_status(204)
+
+    def post(self):
+        """Link the next batch of Sessions from the given cursor."""
+        ConferenceApi._migrateSpeakers(self.request.get('cursor'))
+        self.response.set_status(204)
+
+class ReindexSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start building search documents for existing entities."""
+        ConferenceApi._reindexSearch('Conference')
+        self.response.set_status(204)
+
+    def post(self):
+        """Index the next batch of the given kind from the given cursor."""
+        ConferenceApi._reindexSearch(self.request.get('kind'),
+                                     self.request.get('cursor'))
+        self.response.set_status(204)
+
+class ImportUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
+    def get(self):
+        """Return a URL to POST an import file to."""
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(blobstore.create_upload_url('/tasks/import/upload'))
+
+    def post(self):
+        """Start importing an uploaded JSONL or CSV file.
+
+        Takes the file as 'file', plus 'organizerUserId' and an optional
+        'format' (defaults from the file extension); returns the job id.
+        """
+        uploads = self.get_uploads('file')
+        organizer = self.request.get('organizerUserId')
+        if not uploads or not organizer:
+            self.abort(400, 'file and organizerUserId are required')
+        upload = uploads[0]
+        fmt = self.request.get('format') or (
+            'csv' if upload.filename.lower().endswith('.csv') else 'jsonl')
+        if fmt not in ('jsonl', 'csv'):
+            self.abort(400, 'format must be jsonl or csv')
+        job = bulk.startImport(upload.key(), fmt, organizer)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(str(job.key.id()))
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import the next batch of records for an ImportJob."""
+        bulk.runImportBatch(self.request.get('jobId'))
+        self.response.set_status(204)
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return one page of Conferences or Sessions as JSONL.
+
+        The X-Export-Kind and X-Export-Cursor headers give the kind and
+        cursor parameters for the next page; they are absent after the
+        last page.
+        """
+        try:
+            lines, next_kind, next_cursor = bulk.exportPage(
+                self.request.get('kind') or 'conference',
+                self.request.get('cursor') or None)
+        except ValueError as e:
+            self.abort(400, str(e))
+        if next_kind:
+            self.response.headers['X-Export-Kind'] = next_kind
+            self.response.headers['X-Export-Cursor'] = next_cursor or ''
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        for line in lines:
+            self.response.write(line + '\n')
+
+class RpcStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return average RPCs, wall time and response size per
+        endpoint and handler as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            instrumentation.rpcStats(_instrumentedNames()),
+            indent=2, sort_keys=True))
+
+    def post(self):
+        """Reset the RPC statistics."""
+        instrumentation.resetRpcStats(_instrumentedNames())
+        self.response.set_status(204)
+
+
+def _instrumentedNames():
+    """Return the request paths instrumentation records stats under."""
+    return (['/_ah/spi/ConferenceApi.%s' % name
+             for name in sorted(ConferenceApi.all_remote_methods())] +
+            [path for path, handler in ROUTES])
+
 
-app = webapp2.WSGIApplication([
+ROUTES = [
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_ft_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/backfill_organizer_names', BackfillOrganizerNamesHandler),
+    ('/tasks/sync_seats', SyncSeatsHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/migrate_profiles', MigrateProfilesHandler),
+    ('/tasks/migrate_speakers', MigrateSpeakersHandler),
+    ('/tasks/reindex_search', ReindexSearchHandler),
+    ('/tasks/import/upload', ImportUploadHandler),
+    ('/tasks/import', ImportHandler),
+    ('/tasks/export', ExportHandler),
+    ('/admin/rpc_stats', RpcStatsHandler),
+]
+app = instrumentation.InstrumentationMiddleware(
+    webapp2.WSGIApplication(ROUTES, debug=True))
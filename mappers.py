@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+mappers.py -- copy ndb entities into ProtoRPC form messages
+
+The field pairs and value converters for a (model, message) pair are
+worked out once, on first use, instead of walking all_fields() with
+hasattr/getattr for every entity copied.
+
+"""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+_MAPPERS = {}
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+def _getter(name, convert=None):
+    """Return a function reading property name from an entity."""
+    if convert is None:
+        return lambda entity: getattr(entity, name)
+    return lambda entity: convert(getattr(entity, name))
+
+
+def _enumConverter(enum_type):
+    """Return a converter from an enum value name to enum_type."""
+    return lambda value: getattr(enum_type, value)
+
+
+class FormMapper(object):
+    """Copies entities of one ndb.Model class into one Message class.
+
+    Every message field with a same-named model property is copied;
+    date and time properties are converted to strings, string properties
+    feeding an EnumField are looked up by name, and a websafeKey field is
+    filled from the entity key.
+    """
+
+    def __init__(self, model_class, message_class):
+        self.message_class = message_class
+        self.getters = []
+        properties = model_class._properties
+        for field in message_class.all_fields():
+            name = field.name
+            prop = properties.get(name)
+            if prop is not None:
+                if isinstance(prop, (ndb.DateProperty, ndb.TimeProperty)):
+                    getter = _getter(name, str)
+                elif isinstance(field, messages.EnumField):
+                    getter = _getter(name, _enumConverter(field.type))
+                else:
+                    getter = _getter(name)
+            elif name == 'websafeKey':
+                getter = _websafeKey
+            else:
+                continue
+            self.getters.append((name, getter))
+        self.getters_by_name = dict(self.getters)
+
+    def copy(self, entity, fields=None):
+        """Return a new message copied from entity.
+
+        With fields, only those fields are copied (for example from a
+        projection query) and the message is not checked for required
+        fields.
+        """
+        form = self.message_class()
+        if fields is None:
+            for name, getter in self.getters:
+                setattr(form, name, getter(entity))
+            form.check_initialized()
+        else:
+            for name in fields:
+                getter = self.getters_by_name.get(name)
+                if getter is not None:
+                    setattr(form, name, getter(entity))
+        return form
+
+
+def mapperFor(model_class, message_class):
+    """Return the FormMapper for a model and message class pair."""
+    mapper = _MAPPERS.get((model_class, message_class))
+    if mapper is None:
+        mapper = _MAPPERS[(model_class, message_class)] = FormMapper(
+            model_class, message_class)
+    return mapper
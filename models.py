@@ -16,10 +16,38 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy; registrations and wishlists are stored as child entities
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysWishlist = ndb.StringProperty(repeated=True)
 
 
+class Registration(ndb.Model):
+    """Registration -- Profile child recording attendance of a Conference"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- Profile child queueing for a full Conference"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+    # ticket number from the conference's Waitlist; promoted in order
+    position = ndb.IntegerProperty()
+
+
+class Waitlist(ndb.Model):
+    """Waitlist -- per-Conference waitlist counters, keyed by websafe
+    conference key"""
+    nextPosition = ndb.IntegerProperty(default=1, indexed=False)
+    # entries taken off the head of the list
+    served = ndb.IntegerProperty(default=0, indexed=False)
+    waiting = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Profile child recording a wishlisted Session"""
+    session = ndb.KeyProperty(kind='Session', required=True)
+
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -40,6 +68,26 @@ class StringMessage(messages.Message):
     data = messages.StringField(1, required=True)
 
 
+class RegistrationResultForm(messages.Message):
+    """RegistrationResultForm -- outbound registration result; data is
+    False with a waitlistPosition when the conference is full"""
+    data = messages.BooleanField(1)
+    waitlistPosition = messages.IntegerField(2)
+
+
+class AnnouncementItemForm(messages.Message):
+    """AnnouncementItemForm -- nearly sold out conference outbound message"""
+    websafeConferenceKey = messages.StringField(1)
+    name = messages.StringField(2)
+    seatsAvailable = messages.IntegerField(3)
+
+
+class AnnouncementForm(messages.Message):
+    """AnnouncementForm -- announcement text and its conferences"""
+    data = messages.StringField(1, required=True)
+    items = messages.MessageField(AnnouncementItemForm, 2, repeated=True)
+
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
@@ -50,6 +98,7 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty()
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -59,6 +108,30 @@ class Conference(ndb.Model):
     seatsAvailable  = ndb.IntegerProperty()
 
 
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of a Conference's available seats"""
+    conference = ndb.KeyProperty(kind='Conference')
+    seatsAvailable = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of a bulk import from an uploaded blob"""
+    blobKey = ndb.BlobKeyProperty(required=True)
+    format = ndb.StringProperty(choices=['jsonl', 'csv'], default='jsonl')
+    organizerUserId = ndb.StringProperty(required=True)
+    # checkpoint: byte offset and line number where the next batch starts
+    offset = ndb.IntegerProperty(default=0)
+    lineNumber = ndb.IntegerProperty(default=0)
+    # CSV column names, read from the first line
+    header = ndb.StringProperty(repeated=True, indexed=False)
+    created = ndb.IntegerProperty(default=0)
+    skipped = ndb.IntegerProperty(default=0)
+    errorCount = ndb.IntegerProperty(default=0)
+    # the first MAX_IMPORT_ERRORS errors, as [lineNumber, message]
+    errors = ndb.JsonProperty()
+    done = ndb.BooleanProperty(default=False)
+
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -78,6 +151,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class TeeShirtSize(messages.Enum):
@@ -109,6 +183,8 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
 
 
 class Session(ndb.Model):
@@ -116,10 +192,41 @@ class Session(ndb.Model):
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
     speaker = ndb.StringProperty(required=True)
+    speakerKey = ndb.KeyProperty(kind='Speaker')
     durationInMin = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty(default="NOT_SPECIFIED")
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
+    # precomputed for index-only queries on type and start time
+    isWorkshop = ndb.ComputedProperty(
+        lambda self: self.typeOfSession == 'WORKSHOP')
+    startMinuteOfDay = ndb.ComputedProperty(
+        lambda self: (self.startTime.hour * 60 + self.startTime.minute
+                      if self.startTime else None))
+
+
+class SpeakerIndex(ndb.Model):
+    """SpeakerIndex -- per-Conference map of speaker to their sessions"""
+    # {speakerId: {websafeSessionKey: sessionName}}
+    sessions = ndb.JsonProperty()
+    # {speakerId: speaker name as first entered}
+    names = ndb.JsonProperty()
+
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- search index entry, child of the entity indexed"""
+    kind = ndb.StringProperty()
+    # every prefix of every token in the entity's text fields
+    prefixes = ndb.StringProperty(repeated=True)
+    # {token: weight} used to rank matches
+    weights = ndb.JsonProperty()
+
+
+class Speaker(ndb.Model):
+    """Speaker -- session speaker, keyed by normalized name"""
+    name = ndb.StringProperty(required=True)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True,
+                                  indexed=False)
 
 
 class SessionForm(messages.Message):
@@ -137,11 +244,34 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Sessions outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+
+
+class SessionQueryResultForm(messages.Message):
+    """SessionQueryResultForm -- querySessions outbound form message"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    queryPlan = messages.StringField(3)
 
 
 class SessionTypeForm(messages.Message):
     """SessionTypeForm -- inbound SessionType field"""
     sessionType = messages.StringField(1, required=True)
+    select = messages.StringField(2, repeated=True)
 
 
 class SessionKeyForm(messages.Message):
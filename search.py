@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+search.py -- tokenized inverted index for conference and session search
+
+Each indexed entity gets a SearchDocument child listing every prefix of
+every token in its text fields. A search is then a merge join of
+equality filters on SearchDocument.prefixes, which the datastore serves
+from its built-in indexes, so no composite index or search service is
+needed. Each query term matches any token it is a prefix of.
+
+"""
+
+import re
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+
+DOCUMENT_ID = 'search'
+MAX_TOKEN_LENGTH = 20
+MAX_QUERY_TOKENS = 5
+# an exact token match scores this many times a prefix match
+EXACT_MATCH_BOOST = 2
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with'])
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lower-cased words of text, minus stop words."""
+    if not text:
+        return []
+    return [token[:MAX_TOKEN_LENGTH]
+            for token in _TOKEN_RE.findall(text.lower())
+            if token not in STOP_WORDS]
+
+
+def documentKey(key):
+    """Return the SearchDocument key for an indexed entity's key."""
+    return ndb.Key(SearchDocument, DOCUMENT_ID, parent=key)
+
+
+def buildDocument(key, fields):
+    """Return the SearchDocument for the entity with key.
+
+    fields is a list of (text, weight) pairs; text may also be a list of
+    strings. A token's weight is the sum of the weights of the fields it
+    appears in, once per occurrence.
+    """
+    weights = {}
+    for text, weight in fields:
+        if isinstance(text, (list, tuple)):
+            text = ' '.join(text)
+        for token in tokenize(text):
+            weights[token] = weights.get(token, 0) + weight
+    prefixes = set()
+    for token in weights:
+        prefixes.update(token[:i] for i in range(1, len(token) + 1))
+    return SearchDocument(key=documentKey(key), kind=key.kind(),
+                          prefixes=sorted(prefixes), weights=weights)
+
+
+def buildQuery(kind, text, ancestor=None):
+    """Return (query, tokens) for SearchDocuments of kind matching text.
+
+    Every token must match. The query is None when text has no tokens.
+    """
+    tokens = tokenize(text)[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return None, tokens
+    query = SearchDocument.query(SearchDocument.kind == kind,
+                                 ancestor=ancestor)
+    for token in sorted(set(tokens)):
+        query = query.filter(SearchDocument.prefixes == token)
+    return query, tokens
+
+
+def score(doc, tokens):
+    """Return how well a SearchDocument matches the query tokens."""
+    total = 0
+    for query_token in tokens:
+        best = 0
+        for token, weight in doc.weights.iteritems():
+            if token == query_token:
+                best = max(best, weight * EXACT_MATCH_BOOST)
+            elif token.startswith(query_token):
+                best = max(best, weight)
+        total += best
+    return total
+
+
+def rank(docs, tokens):
+    """Return the keys of the entities docs index, best match first."""
+    ranked = sorted(docs, key=lambda doc: score(doc, tokens), reverse=True)
+    return [doc.key.parent() for doc in ranked]
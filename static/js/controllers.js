@@ -293,6 +293,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the token for the next page of queryConferences results, if any.
+     * @type {string}
+     */
+    $scope.nextPageToken = null;
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -425,10 +431,16 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param pageToken the token of the page to append; starts a new query when omitted.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (pageToken) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize
+        }
+        if (pageToken) {
+            sendFilters.pageToken = pageToken;
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -458,16 +470,28 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!pageToken) {
+                            $scope.conferences = [];
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.nextPageToken = resp.nextPageToken || null;
                     }
                     $scope.submitted = true;
                 });
             });
     }
 
+    /**
+     * Fetches the next page of the current conference query.
+     */
+    $scope.queryConferencesMore = function () {
+        if ($scope.nextPageToken) {
+            $scope.queryConferencesAll($scope.nextPageToken);
+        }
+    };
+
     /**
      * Invokes the conference.getConferencesCreated method.
      */
@@ -624,7 +648,12 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         return;
                     }
                 } else {
-                    if (resp.result) {
+                    if (resp.result && resp.result.waitlistPosition) {
+                        // Sold out; the user was put on the waitlist.
+                        $scope.messages = 'The conference is full. You are number ' +
+                            resp.result.waitlistPosition + ' on the waitlist';
+                        $scope.alertStatus = 'info';
+                    } else if (resp.result) {
                         // Register succeeded.
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
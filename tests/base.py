@@ -0,0 +1,33 @@
+"""
+base.py -- shared setup for the tests, which run against the App Engine
+local stubs
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import loadtest
+
+SDK = os.environ.get('APPENGINE_SDK')
+if not SDK:
+    raise ImportError('set APPENGINE_SDK to the App Engine Python SDK path')
+loadtest.fixSysPath(SDK)
+
+
+class TestbedTestCase(unittest.TestCase):
+    """Runs each test against fresh datastore, memcache, taskqueue,
+    urlfetch and mail stubs."""
+
+    def setUp(self):
+        self.testbed = loadtest.setUpTestbed(SDK)
+        from google.appengine.ext import ndb
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
@@ -0,0 +1,58 @@
+"""
+test_bulk.py -- bulk import validation
+"""
+
+import unittest
+
+import base
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+
+import bulk
+from models import Conference
+from models import ImportJob
+from models import Profile
+
+ORGANIZER = 'organizer@example.com'
+
+
+class ImportRecordsTest(base.TestbedTestCase):
+
+    def setUp(self):
+        super(ImportRecordsTest, self).setUp()
+        Profile(key=ndb.Key(Profile, ORGANIZER), displayName='Organizer',
+                mainEmail=ORGANIZER, teeShirtSize='NOT_SPECIFIED').put()
+        self.job = ImportJob(blobKey=blobstore.BlobKey('upload'),
+                             format='jsonl', organizerUserId=ORGANIZER,
+                             errors=[])
+
+    def testRecordsMalformedTypesAndContinues(self):
+        bulk._importRecords(self.job, [
+            (1, {'kind': 'conference', 'id': 'a', 'name': 'A',
+                 'maxAttendees': [1]}),
+            (2, {'kind': 'conference', 'id': 'b', 'name': 'B',
+                 'maxAttendees': {'a': 1}}),
+            (3, {'kind': 'conference', 'id': 'c', 'name': 'C',
+                 'topics': [['nested']]}),
+            (4, {'kind': 'conference', 'id': 'd', 'name': 'D',
+                 'maxAttendees': 10}),
+        ])
+        self.assertEqual(self.job.errorCount, 3)
+        self.assertEqual([line for line, error in self.job.errors],
+                         [1, 2, 3])
+        self.assertEqual(self.job.created, 1)
+        self.assertEqual(
+            ndb.Key(Profile, ORGANIZER, Conference, 'd').get().name, 'D')
+
+    def testNumericIdsRoundTripAsIntegerKeys(self):
+        record = {'kind': 'conference', 'id': '7', 'name': 'Seven'}
+        bulk._importRecords(self.job, [(1, record)])
+        conf = ndb.Key(Profile, ORGANIZER, Conference, 7).get()
+        self.assertEqual(bulk._exportRecord('conference', conf)['id'], '7')
+        bulk._importRecords(self.job, [(2, record)])
+        self.assertEqual((self.job.created, self.job.skipped), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+test_confirmation_email.py -- batched conference confirmation emails sent
+from the pull queue
+"""
+
+import time
+import unittest
+
+import base
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conference
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+
+
+class FailingMail(object):
+    """Stands in for the mail module when the mail service is down."""
+
+    def send_mail(self, *args, **kwargs):
+        raise Exception('mail service unavailable')
+
+
+class ConfirmationEmailTest(base.TestbedTestCase):
+
+    def setUp(self):
+        super(ConfirmationEmailTest, self).setUp()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.queue = taskqueue.Queue(conference.CONFIRMATION_EMAIL_QUEUE)
+        self.saved = (conference.CONFIRMATION_EMAILS_PER_SECOND,
+                      conference.CONFIRMATION_EMAIL_LEASE_SECONDS,
+                      conference.mail)
+        # don't pace sends in tests
+        conference.CONFIRMATION_EMAILS_PER_SECOND = 1000000
+        self.next_id = 1
+
+    def tearDown(self):
+        (conference.CONFIRMATION_EMAILS_PER_SECOND,
+         conference.CONFIRMATION_EMAIL_LEASE_SECONDS,
+         conference.mail) = self.saved
+        super(ConfirmationEmailTest, self).tearDown()
+
+    def queueConference(self, email, name, wsck=None):
+        """Queue a confirmation for a conference; returns its wsck."""
+        if wsck is None:
+            wsck = ndb.Key(Profile, email, Conference,
+                           self.next_id).urlsafe()
+            self.next_id += 1
+        ConferenceApi._queueConfirmationEmail(email, wsck, ConferenceForm(
+            name=name, city='London', startDate='2026-11-01',
+            endDate='2026-11-02', topics=['Web Technologies'],
+            maxAttendees=10))
+        return wsck
+
+    def sentTo(self, email):
+        return self.mail_stub.get_sent_messages(to=email)
+
+    def queued(self):
+        return self.taskqueue_stub.GetTasks(
+            conference.CONFIRMATION_EMAIL_QUEUE)
+
+    def testGroupsConferencesByOrganizer(self):
+        self.queueConference('a@example.com', 'First')
+        self.queueConference('a@example.com', 'Second')
+        self.queueConference('b@example.com', 'Third')
+
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 2)
+        [message] = self.sentTo('a@example.com')
+        self.assertEqual(message.subject, 'You created 2 new Conferences!')
+        body = message.body.decode()
+        self.assertIn('First', body)
+        self.assertIn('Second', body)
+        [message] = self.sentTo('b@example.com')
+        self.assertEqual(message.subject, 'You created a new Conference!')
+        self.assertIn('Third', message.body.decode())
+        self.assertEqual(self.queued(), [])
+
+    def testConfirmsEachConferenceOnce(self):
+        wsck = self.queueConference('a@example.com', 'Repeated')
+        self.queueConference('a@example.com', 'Repeated', wsck)
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 1)
+        [message] = self.sentTo('a@example.com')
+        self.assertEqual(message.body.decode().count('Repeated'), 1)
+
+        # a task leased again after it was sent is dropped unsent
+        self.queueConference('a@example.com', 'Repeated', wsck)
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 0)
+        self.assertEqual(len(self.sentTo('a@example.com')), 1)
+        self.assertEqual(self.queued(), [])
+
+    def testSkipsTasksLeasedElsewhere(self):
+        self.queueConference('a@example.com', 'Leased')
+        self.queue.lease_tasks(60, 1)
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 0)
+        self.assertEqual(self.sentTo('a@example.com'), [])
+        self.assertEqual(len(self.queued()), 1)
+
+    def testFailedSendsAreLeasedAgain(self):
+        conference.CONFIRMATION_EMAIL_LEASE_SECONDS = 1
+        self.queueConference('a@example.com', 'First')
+        self.queueConference('b@example.com', 'Second')
+
+        conference.mail = FailingMail()
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 0)
+        self.assertEqual(len(self.queued()), 2)
+
+        # once the lease runs out the emails go out
+        conference.mail = self.saved[2]
+        time.sleep(1.5)
+        self.assertEqual(ConferenceApi._sendConfirmationEmails(), 2)
+        self.assertEqual(len(self.sentTo('a@example.com')), 1)
+        self.assertEqual(len(self.sentTo('b@example.com')), 1)
+        self.assertEqual(self.queued(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
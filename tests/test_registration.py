@@ -0,0 +1,130 @@
+"""
+test_registration.py -- concurrent registrations against the sharded seat
+counters
+"""
+
+import random
+import threading
+import unittest
+
+import base
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+import conference as c
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Waitlist
+from models import WaitlistEntry
+
+SEATS = 25
+USERS = 60
+THREADS = 8
+
+
+class ConcurrentRegistrationTest(base.TestbedTestCase):
+
+    def setUp(self):
+        super(ConcurrentRegistrationTest, self).setUp()
+        conf = Conference(
+            key=ndb.Key(Profile, 'organizer@example.com', Conference, 1),
+            name='Concurrency', organizerUserId='organizer@example.com',
+            maxAttendees=SEATS, seatsAvailable=SEATS)
+        ndb.put_multi([conf] + ConferenceApi._newConferenceEntities(conf))
+        self.wsck = conf.key.urlsafe()
+        self.emails = ['user%d@example.com' % i for i in range(USERS)]
+
+    def call(self, email, register):
+        api = ConferenceApi()
+        api._user = users.User(email)
+        ndb.get_context().clear_cache()
+        request = c.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck)
+        if register:
+            return api.registerForConference(request)
+        return api.unregisterFromConference(request)
+
+    def runConcurrently(self, work):
+        """Run work(email, rng) for every user spread over THREADS
+        threads; returns the number of calls that failed."""
+        failures = [0]
+        lock = threading.Lock()
+
+        def worker(index):
+            rng = random.Random(index)
+            for email in self.emails[index::THREADS]:
+                try:
+                    work(email, rng)
+                except (datastore_errors.TransactionFailedError,
+                        endpoints.ServiceException):
+                    with lock:
+                        failures[0] += 1
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failures[0]
+
+    def assertSeatsConsistent(self):
+        """Seats held plus seats left must equal the conference size."""
+        ndb.get_context().clear_cache()
+        c_key = ndb.Key(urlsafe=self.wsck)
+        shards = ndb.get_multi(ConferenceApi._seatShardKeys(c_key))
+        self.assertTrue(all(shard.seatsAvailable >= 0 for shard in shards))
+        regs = [reg for reg in ndb.get_multi([
+            ConferenceApi._registrationKey(ndb.Key(Profile, email),
+                                           self.wsck)
+            for email in self.emails]) if reg]
+        self.assertLessEqual(len(regs), SEATS)
+        self.assertEqual(
+            len(regs) + sum(shard.seatsAvailable for shard in shards), SEATS)
+
+        entries = WaitlistEntry.query(
+            WaitlistEntry.conference == c_key).count()
+        waitlist = ConferenceApi._waitlistCounterKey(self.wsck).get()
+        self.assertEqual(waitlist.waiting if waitlist else 0, entries)
+        return regs
+
+    def testRegistrationsNeverOversell(self):
+        failures = self.runConcurrently(
+            lambda email, rng: self.call(email, True))
+        regs = self.assertSeatsConsistent()
+        # everyone either got a seat or is waiting for one
+        waitlist = ConferenceApi._waitlistCounterKey(self.wsck).get()
+        self.assertEqual(len(regs) + waitlist.waiting + failures, USERS)
+
+        # seats lost to races go to the waitlist once the worker runs
+        ConferenceApi._promoteWaitlist(self.wsck)
+        self.assertEqual(len(self.assertSeatsConsistent()), SEATS)
+
+    def testInterleavedRegisterAndUnregister(self):
+        def work(email, rng):
+            self.call(email, True)
+            if rng.random() < 0.5:
+                self.call(email, False)
+
+        self.runConcurrently(work)
+        self.assertSeatsConsistent()
+        ConferenceApi._promoteWaitlist(self.wsck)
+        self.assertSeatsConsistent()
+
+    def testShrinkingAddsConferenceToAnnouncement(self):
+        api = ConferenceApi()
+        api._user = users.User('organizer@example.com')
+        api.updateConference(c.CONF_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck, maxAttendees=3))
+        announcement = ConferenceApi().getAnnouncement(
+            c.message_types.VoidMessage())
+        self.assertEqual([(item.websafeConferenceKey, item.seatsAvailable)
+                          for item in announcement.items], [(self.wsck, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+test_search.py -- search ranking and paging
+"""
+
+import unittest
+
+import base
+
+from google.appengine.ext import ndb
+
+import conference as c
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+
+
+class SearchConferencesTest(base.TestbedTestCase):
+
+    def addConference(self, c_id, name, description=''):
+        conf = Conference(
+            key=ndb.Key(Profile, 'organizer@example.com', Conference, c_id),
+            name=name, description=description,
+            organizerUserId='organizer@example.com')
+        ndb.put_multi([conf] + ConferenceApi._newConferenceEntities(conf))
+
+    def search(self, q, page_size, page_token=None):
+        return ConferenceApi().searchConferences(
+            c.SEARCH_REQUEST.combined_message_class(
+                q=q, pageSize=page_size, pageToken=page_token))
+
+    def testRanksBeforePaging(self):
+        # only mentioned in descriptions, and first in index order
+        for c_id in range(1, 6):
+            self.addConference(c_id, 'Meetup %d' % c_id, 'about python')
+        self.addConference(6, 'Python')
+
+        first = self.search('python', 2)
+        self.assertEqual(first.items[0].name, 'Python')
+
+        names = [form.name for form in first.items]
+        token = first.nextPageToken
+        while token:
+            page = self.search('python', 2, token)
+            names.extend(form.name for form in page.items)
+            token = page.nextPageToken
+        self.assertEqual(sorted(names), sorted(
+            ['Python'] + ['Meetup %d' % c_id for c_id in range(1, 6)]))
+
+    def testPagesPastCandidateWindow(self):
+        self.addCleanup(setattr, c, 'MAX_SEARCH_CANDIDATES',
+                        c.MAX_SEARCH_CANDIDATES)
+        c.MAX_SEARCH_CANDIDATES = 3
+        for c_id in range(1, 9):
+            self.addConference(c_id, 'Python %d' % c_id)
+
+        names = []
+        token = None
+        while True:
+            page = self.search('python', 2, token)
+            names.extend(form.name for form in page.items)
+            token = page.nextPageToken
+            if not token:
+                break
+            self.assertEqual(len(page.items), 2)
+        self.assertEqual(sorted(names),
+                         ['Python %d' % c_id for c_id in range(1, 9)])
+
+    def testRejectsBadPageToken(self):
+        self.addConference(1, 'Python')
+        with self.assertRaises(c.endpoints.BadRequestException):
+            self.search('python', 2, 'not-a-token')
+
+
+if __name__ == '__main__':
+    unittest.main()
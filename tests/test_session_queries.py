@@ -0,0 +1,131 @@
+"""
+test_session_queries.py -- session query planning, and paging of session
+queries that filter part of their results in memory
+"""
+
+import datetime
+import unittest
+
+import base
+
+from google.appengine.ext import ndb
+
+import conference as c
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionQueryForm
+from models import SessionQueryForms
+
+
+class SessionQueryTestCase(base.TestbedTestCase):
+
+    def setUp(self):
+        super(SessionQueryTestCase, self).setUp()
+        self.c_key = ndb.Key(Profile, 'organizer@example.com',
+                             Conference, 1)
+
+    def addSession(self, s_id, stype, hour, speaker='Ada', duration=60):
+        Session(key=ndb.Key(Session, s_id, parent=self.c_key),
+                name='Session %d' % s_id, speaker=speaker,
+                speakerKey=ConferenceApi._speakerKey(speaker),
+                typeOfSession=stype, durationInMin=duration,
+                date=datetime.date(2026, 5, 1),
+                startTime=datetime.time(hour)).put()
+
+    def readAll(self, call):
+        """Page through call(pageToken); returns the pages' item names."""
+        pages = []
+        token = None
+        while True:
+            result = call(token)
+            pages.append([form.name for form in result.items])
+            token = result.nextPageToken
+            if not token:
+                return pages
+
+
+class EarlySessionsTest(SessionQueryTestCase):
+
+    def testFillsPagesPastExcludedTypes(self):
+        for s_id in range(1, 13):
+            self.addSession(s_id, ['KEYNOTE', 'LECTURE', 'WORKSHOP'][
+                s_id % 3], 8 + s_id % 6)
+
+        pages = self.readAll(lambda token: ConferenceApi(
+            ).getEarlyNonWorkshopSessions(
+                c.EARLY_SESH_REQUEST.combined_message_class(
+                    excludeTypes=['WORKSHOP', 'LECTURE'], pageSize=2,
+                    pageToken=token)))
+        # only the last page may be short
+        self.assertTrue(all(len(page) == 2 for page in pages[:-1]))
+        self.assertEqual(sorted(sum(pages, [])), sorted(
+            'Session %d' % s_id for s_id in range(3, 13, 3)))
+
+
+class QuerySessionsTest(SessionQueryTestCase):
+
+    def setUp(self):
+        super(QuerySessionsTest, self).setUp()
+        for s_id in range(1, 25):
+            self.addSession(s_id, ['KEYNOTE', 'LECTURE', 'WORKSHOP'][
+                s_id % 3], 8 + s_id % 8, duration=[30, 60, 90][s_id % 3])
+        self.sessions = Session.query().fetch()
+
+    def filters(self, *triples):
+        return [SessionQueryForm(field=field, operator=op, value=value)
+                for field, op, value in triples]
+
+    def plan(self, *triples):
+        api = ConferenceApi()
+        return api._planSessionQuery(
+            api._formatSessionFilters(self.filters(*triples)))
+
+    def query(self, *triples):
+        """Page through querySessions two at a time; returns the pages."""
+        return self.readAll(lambda token: ConferenceApi().querySessions(
+            SessionQueryForms(filters=self.filters(*triples), pageSize=2,
+                              pageToken=token)))
+
+    def assertPages(self, pages, expected):
+        # only the last page may be short
+        self.assertTrue(all(len(page) == 2 for page in pages[:-1]))
+        self.assertEqual(sorted(sum(pages, [])),
+                         sorted(sesh.name for sesh in expected))
+
+    def testPushesEqualityAndInequalityToCompositeIndex(self):
+        triples = (('TYPE', 'EQ', 'KEYNOTE'), ('START_TIME', 'LT', '12:00'))
+        pushed, remaining, plan = self.plan(*triples)
+        self.assertEqual(len(pushed), 2)
+        self.assertEqual(remaining, [])
+        self.assertEqual(plan, 'composite index on '
+                         'Session(typeOfSession, startMinuteOfDay)')
+        self.assertPages(self.query(*triples), [
+            sesh for sesh in self.sessions if sesh.typeOfSession ==
+            'KEYNOTE' and sesh.startTime < datetime.time(12)])
+
+    def testRunsSecondInequalityInMemory(self):
+        triples = (('START_TIME', 'LT', '12:00'), ('DURATION', 'GT', '30'))
+        pushed, remaining, plan = self.plan(*triples)
+        # the datastore takes one inequality property per query
+        self.assertEqual(len(pushed), 1)
+        self.assertEqual(len(remaining), 1)
+        self.assertIn('; in memory: %s' % remaining[0]['field'], plan)
+        self.assertPages(self.query(*triples), [
+            sesh for sesh in self.sessions if sesh.durationInMin > 30 and
+            sesh.startTime < datetime.time(12)])
+
+    def testFallsBackToKindScanInMemory(self):
+        triples = (('TYPE', 'NE', 'WORKSHOP'),)
+        pushed, remaining, plan = self.plan(*triples)
+        self.assertEqual(pushed, [])
+        self.assertEqual(plan, 'kind scan of Session; '
+                         'in memory: typeOfSession !=')
+        self.assertPages(self.query(*triples), [
+            sesh for sesh in self.sessions
+            if sesh.typeOfSession != 'WORKSHOP'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+"""
+test_utils.py -- ID token verification, the signing cert cache and the
+tokeninfo circuit breaker, against a local stand-in for Google's token
+endpoints
+"""
+
+import base64
+import json
+import time
+import unittest
+
+import base
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+
+import utils
+
+KEY = RSA.generate(1024)
+KID = 'test-key'
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def longToB64(value):
+    data = ('%x' % value)
+    return b64encode(('0' * (len(data) % 2) + data).decode('hex'))
+
+
+def makeIdToken(key=KEY, kid=KID, **claims):
+    """Return an RS256 ID token signed with key; claims override a valid
+    payload for this app."""
+    payload = {'iss': 'accounts.google.com', 'sub': '1234',
+               'aud': utils.WEB_CLIENT_ID, 'azp': utils.WEB_CLIENT_ID,
+               'exp': int(time.time()) + 3600}
+    payload.update(claims)
+    signing_input = '%s.%s' % (
+        b64encode(json.dumps({'alg': 'RS256', 'kid': kid})),
+        b64encode(json.dumps(payload)))
+    signature = PKCS1_v1_5.new(key).sign(SHA256.new(signing_input))
+    return '%s.%s' % (signing_input, b64encode(signature))
+
+
+class FakeUrlFetchStub(apiproxy_stub.APIProxyStub):
+    """Answers fetches from routes, a dict of URL prefix to a
+    (status, content, headers) tuple, and records the URLs fetched."""
+
+    def __init__(self):
+        super(FakeUrlFetchStub, self).__init__('urlfetch')
+        self.routes = {}
+        self.fetched = []
+
+    def _Dynamic_Fetch(self, request, response):
+        self.fetched.append(request.url())
+        status, content, headers = 404, '', {}
+        for prefix, route in self.routes.items():
+            if request.url().startswith(prefix):
+                status, content, headers = route
+        response.set_statuscode(status)
+        response.set_content(content)
+        for name, value in headers.items():
+            header = response.add_header()
+            header.set_key(name)
+            header.set_value(value)
+
+    def count(self, prefix):
+        return len([url for url in self.fetched if url.startswith(prefix)])
+
+
+class TokenTestCase(base.TestbedTestCase):
+
+    def setUp(self):
+        super(TokenTestCase, self).setUp()
+        self.urlfetch = FakeUrlFetchStub()
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', self.urlfetch)
+        self.serveCerts(200, KEY)
+        # module level state outlives a testbed
+        utils._certs.update(keys={}, expires=0)
+        utils._certs_breaker = utils.CircuitBreaker()
+        utils._tokeninfo_breaker = utils.CircuitBreaker()
+
+    def serveCerts(self, status, key):
+        jwks = {'keys': [{'kid': KID, 'kty': 'RSA', 'alg': 'RS256',
+                          'n': longToB64(key.n), 'e': longToB64(key.e)}]}
+        self.urlfetch.routes[utils.GOOGLE_CERTS_URL] = (
+            status, json.dumps(jwks), {'Cache-Control': 'max-age=3600'})
+
+    def serveTokenInfo(self, status, info=None):
+        self.urlfetch.routes[utils.TOKENINFO_URL.split('?')[0]] = (
+            status, json.dumps(info or {}), {})
+
+
+class VerifyIdTokenTest(TokenTestCase):
+
+    def testVerifiesToken(self):
+        exp = int(time.time()) + 60
+        self.assertEqual(utils._verifyIdToken(makeIdToken(exp=exp)),
+                         ('1234', exp))
+
+    def testRejectsTamperedPayload(self):
+        header, payload, signature = makeIdToken().split('.')
+        forged = makeIdToken(sub='5678').split('.')[1]
+        self.assertEqual(utils._verifyIdToken(
+            '.'.join([header, forged, signature])), ('', 0))
+
+    def testRejectsOtherSigningKey(self):
+        token = makeIdToken(key=RSA.generate(1024))
+        self.assertEqual(utils._verifyIdToken(token), ('', 0))
+
+    def testRejectsUnknownKid(self):
+        self.assertEqual(utils._verifyIdToken(makeIdToken(kid='other')),
+                         ('', 0))
+
+    def testRejectsMalformedToken(self):
+        self.assertEqual(utils._verifyIdToken('not.a-token'), ('', 0))
+
+    def testRejectsExpiredToken(self):
+        token = makeIdToken(exp=int(time.time()) - utils.CLOCK_SKEW - 60)
+        self.assertEqual(utils._verifyIdToken(token), ('', 0))
+
+    def testRejectsOtherIssuer(self):
+        token = makeIdToken(iss='https://example.com')
+        self.assertEqual(utils._verifyIdToken(token), ('', 0))
+
+    def testRejectsOtherAudience(self):
+        token = makeIdToken(aud='other-app', azp='other-app')
+        self.assertEqual(utils._verifyIdToken(token), ('', 0))
+
+    def testRejectsOtherAuthorizedParty(self):
+        token = makeIdToken(azp='other-app')
+        self.assertEqual(utils._verifyIdToken(token), ('', 0))
+
+    def testAcceptsAndroidAudience(self):
+        token = makeIdToken(aud=utils.ANDROID_AUDIENCE,
+                            azp=utils.ANDROID_CLIENT_ID)
+        self.assertEqual(utils._verifyIdToken(token)[0], '1234')
+
+
+class SigningKeyCacheTest(TokenTestCase):
+
+    def testCachesCertsForMaxAge(self):
+        utils._verifyIdToken(makeIdToken())
+        utils._verifyIdToken(makeIdToken())
+        self.assertEqual(self.urlfetch.count(utils.GOOGLE_CERTS_URL), 1)
+        self.assertGreater(utils._certs['expires'], time.time() + 3000)
+
+    def testRefreshesExpiredCerts(self):
+        utils._verifyIdToken(makeIdToken())
+        utils._certs['expires'] = 0
+        new_key = RSA.generate(1024)
+        self.serveCerts(200, new_key)
+        self.assertEqual(utils._verifyIdToken(makeIdToken(key=new_key))[0],
+                         '1234')
+        self.assertEqual(self.urlfetch.count(utils.GOOGLE_CERTS_URL), 2)
+
+    def testKeepsKeysWhenRefreshFails(self):
+        utils._verifyIdToken(makeIdToken())
+        utils._certs['expires'] = 0
+        self.serveCerts(500, KEY)
+        self.assertEqual(utils._verifyIdToken(makeIdToken())[0], '1234')
+        # the failed refresh is not retried on the next request
+        utils._verifyIdToken(makeIdToken())
+        self.assertEqual(self.urlfetch.count(utils.GOOGLE_CERTS_URL), 2)
+
+
+class TokenInfoTest(TokenTestCase):
+
+    def testReturnsUserIdForThisApp(self):
+        self.serveTokenInfo(200, {'user_id': '1234', 'expires_in': 60,
+                                  'issued_to': utils.WEB_CLIENT_ID})
+        user_id, expires = utils._fetchTokenInfoUserId(
+            'token', ['access_token'])
+        self.assertEqual(user_id, '1234')
+        self.assertAlmostEqual(expires, time.time() + 60, delta=5)
+
+    def testRejectsTokenIssuedToOtherApp(self):
+        self.serveTokenInfo(200, {'user_id': '1234',
+                                  'issued_to': 'other-app'})
+        self.assertEqual(
+            utils._fetchTokenInfoUserId('token', ['access_token']), ('', 0))
+
+    def testDoesNotRetryRejectedToken(self):
+        self.serveTokenInfo(400)
+        utils._fetchTokenInfoUserId('token', ['access_token'])
+        self.assertEqual(len(self.urlfetch.fetched), 1)
+
+    def testRetriesServerErrors(self):
+        self.serveTokenInfo(503)
+        utils._fetchTokenInfoUserId('token', ['access_token'])
+        self.assertEqual(len(self.urlfetch.fetched),
+                         utils.TOKENINFO_ATTEMPTS)
+
+    def testBreakerStopsCallsUntilReset(self):
+        breaker = utils._tokeninfo_breaker = utils.CircuitBreaker(
+            threshold=utils.TOKENINFO_ATTEMPTS, reset_after=30)
+        self.serveTokenInfo(503)
+        utils._fetchTokenInfoUserId('token', ['access_token'])
+        fetched = len(self.urlfetch.fetched)
+
+        # open: fail fast without calling the service
+        self.assertEqual(
+            utils._fetchTokenInfoUserId('token', ['access_token']), ('', 0))
+        self.assertEqual(len(self.urlfetch.fetched), fetched)
+
+        # after the cool-down one probe goes through and closes it
+        breaker.opened_at -= breaker.reset_after
+        self.serveTokenInfo(200, {'user_id': '1234',
+                                  'issued_to': utils.WEB_CLIENT_ID})
+        self.assertEqual(
+            utils._fetchTokenInfoUserId('token', ['access_token'])[0],
+            '1234')
+        self.assertIsNone(breaker.opened_at)
+
+
+class TokenCacheTest(TokenTestCase):
+
+    def setUp(self):
+        super(TokenCacheTest, self).setUp()
+        utils._token_cache.clear()
+
+    def getUserId(self, token):
+        self.testbed.setup_env(http_authorization='Bearer ' + token,
+                               overwrite=True)
+        return utils.getUserId(None, id_type='oauth')
+
+    def testCachesUntilTokenExpires(self):
+        exp = int(time.time()) + 60
+        token = makeIdToken(exp=exp)
+        self.assertEqual(self.getUserId(token), '1234')
+        self.assertEqual(utils._token_cache.values(), [('1234', exp)])
+
+    def testCachesForTtlAtMost(self):
+        self.assertEqual(self.getUserId(makeIdToken()), '1234')
+        (user_id, expires), = utils._token_cache.values()
+        self.assertLessEqual(expires, time.time() + utils.TOKEN_CACHE_TTL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,243 @@
+import base64
+import binascii
+import hashlib
 import json
 import os
+import re
+import threading
 import time
 import uuid
 
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+import endpoints
 from google.appengine.api import urlfetch
 from models import Profile
+from settings import WEB_CLIENT_ID
+from settings import ANDROID_CLIENT_ID
+from settings import IOS_CLIENT_ID
+from settings import ANDROID_AUDIENCE
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 3
+TOKENINFO_ATTEMPTS = 2
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+CERTS_DEADLINE = 3
+# used when the certs response has no max-age, or after a failed refresh
+CERTS_DEFAULT_MAX_AGE = 60 * 60
+CERTS_RETRY_AFTER = 60
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# the same clients and audiences the ConferenceApi accepts
+ALLOWED_CLIENT_IDS = (WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID,
+                      endpoints.API_EXPLORER_CLIENT_ID)
+ID_TOKEN_AUDIENCES = ALLOWED_CLIENT_IDS + (ANDROID_AUDIENCE,)
+CLOCK_SKEW = 5 * 60
+
+# token -> user_id lookups are cached per instance for this many seconds
+TOKEN_CACHE_TTL = 5 * 60
+TOKEN_CACHE_SIZE = 1000
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
+
+def _tokenCacheKey(token):
+    # don't keep bearer tokens themselves in memory
+    return hashlib.sha256(token).hexdigest()
+
+
+def _getCachedUserId(token):
+    """Return the cached user_id for a bearer token, or None."""
+    key = _tokenCacheKey(token)
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is None:
+            return None
+        user_id, expires = entry
+        if expires < time.time():
+            del _token_cache[key]
+            return None
+        return user_id
+
+
+def _cacheUserId(token, user_id, expires):
+    """Cache the user_id for a bearer token for TOKEN_CACHE_TTL seconds,
+    or until the token expires if that is sooner."""
+    now = time.time()
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_SIZE:
+            # drop expired entries, then the soonest to expire if still full
+            for key, (unused_id, expires) in _token_cache.items():
+                if expires < now:
+                    del _token_cache[key]
+            if len(_token_cache) >= TOKEN_CACHE_SIZE:
+                del _token_cache[min(_token_cache,
+                                     key=lambda k: _token_cache[k][1])]
+        _token_cache[_tokenCacheKey(token)] = (
+            user_id, min(now + TOKEN_CACHE_TTL, expires))
+
+
+class CircuitBreaker(object):
+    """Stops calls to a failing remote service for a cool-down period.
+
+    After threshold consecutive failures the breaker opens and allow()
+    returns False for reset_after seconds; then one call is let through
+    and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_after:
+                # half-open: let this call probe the service
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.time()
+
+
+_tokeninfo_breaker = CircuitBreaker()
+_certs_breaker = CircuitBreaker()
+_certs = {'keys': {}, 'expires': 0}
+_certs_lock = threading.Lock()
+
+
+def _b64decode(data):
+    """Decode unpadded base64url data."""
+    data = str(data)
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _b64ToLong(data):
+    return long(binascii.hexlify(_b64decode(data)), 16)
+
+
+def _getSigningKeys():
+    """Return Google's ID token signing keys as a dict of kid to RSA key.
+
+    Keys are cached for the max-age Google sends and refreshed with a
+    bounded fetch; if a refresh fails the previous keys are kept.
+    """
+    now = time.time()
+    with _certs_lock:
+        if _certs['expires'] > now:
+            return _certs['keys']
+        # one request refreshes; others use the current keys meanwhile
+        _certs['expires'] = now + CERTS_RETRY_AFTER
+        keys = _certs['keys']
+    if not _certs_breaker.allow():
+        return keys
+
+    try:
+        resp = urlfetch.fetch(GOOGLE_CERTS_URL, deadline=CERTS_DEADLINE)
+        ok = resp.status_code == 200
+    except urlfetch.Error:
+        ok = False
+    _certs_breaker.record(ok)
+    if not ok:
+        return keys
+
+    keys = {}
+    for jwk in json.loads(resp.content).get('keys', []):
+        keys[jwk['kid']] = RSA.construct(
+            (_b64ToLong(jwk['n']), _b64ToLong(jwk['e'])))
+    max_age = re.search(r'max-age=(\d+)',
+                        resp.headers.get('Cache-Control', ''))
+    with _certs_lock:
+        _certs['keys'] = keys
+        _certs['expires'] = now + (int(max_age.group(1)) if max_age
+                                   else CERTS_DEFAULT_MAX_AGE)
+    return keys
+
+
+def _verifyIdToken(token):
+    """Return (user ID, expiry time) of a locally verified Google ID
+    token, or ('', 0)."""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        payload = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (TypeError, ValueError):
+        return '', 0
+    if header.get('alg') != 'RS256':
+        return '', 0
+    key = _getSigningKeys().get(header.get('kid'))
+    if key is None:
+        return '', 0
+    digest = SHA256.new('%s.%s' % (header_b64, payload_b64))
+    if not PKCS1_v1_5.new(key).verify(digest, signature):
+        return '', 0
+    if payload.get('iss') not in ID_TOKEN_ISSUERS:
+        return '', 0
+    # a token minted for another app must not sign users in here
+    if (payload.get('aud') not in ID_TOKEN_AUDIENCES or
+            payload.get('azp', payload.get('aud')) not in ALLOWED_CLIENT_IDS):
+        return '', 0
+    if payload.get('exp', 0) < time.time() - CLOCK_SKEW:
+        return '', 0
+    return payload.get('sub', ''), payload['exp']
+
+
+def _fetchTokenInfoUserId(token, token_types):
+    """Return (user ID, expiry time) of a token from the tokeninfo
+    endpoint, or ('', 0).
+
+    Every token type is queried at once with asynchronous fetches under
+    one overall deadline. Failures are retried without sleeping, at most
+    TOKENINFO_ATTEMPTS times, and not at all while the breaker is open.
+    """
+    deadline = time.time() + TOKENINFO_DEADLINE
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        remaining = deadline - time.time()
+        if remaining <= 0 or not _tokeninfo_breaker.allow():
+            break
+        rpcs = []
+        for token_type in token_types:
+            rpc = urlfetch.create_rpc(deadline=remaining)
+            urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+            rpcs.append(rpc)
+
+        retry = False
+        for rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                retry = True
+                continue
+            if resp.status_code == 200:
+                _tokeninfo_breaker.record(True)
+                info = json.loads(resp.content)
+                if info.get('issued_to') not in ALLOWED_CLIENT_IDS:
+                    return '', 0
+                return (info.get('user_id', ''),
+                        time.time() + int(info.get('expires_in', 0)))
+            # 4xx means the service answered and rejected this token type
+            if resp.status_code >= 500:
+                retry = True
+        _tokeninfo_breaker.record(not retry)
+        if not retry:
+            break
+    return '', 0
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,25 +247,22 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
+        user_id = _getCachedUserId(token)
+        if user_id:
+            return user_id
         if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+            user_id, expires = _fetchTokenInfoUserId(token, ['access_token'])
+        else:
+            # ID tokens are verified locally against Google's signing
+            # certs; tokeninfo is only a fallback, tried both as an ID
+            # token and as an access token
+            user_id, expires = _verifyIdToken(token)
+            if not user_id:
+                user_id, expires = _fetchTokenInfoUserId(
+                    token, ['id_token', 'access_token'])
+        if user_id:
+            _cacheUserId(token, user_id, expires)
+        return user_id
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm